@@ -1,8 +1,13 @@
+from curators import sample_sequences
 from databases import Network
+from instruments import INSTRUMENTS
 from math import exp
+import multiprocessing
+import numpy
 
 
-PRINT = True
+# Step sampler of the shards run in this process, see set_shard_step_sampler
+SHARD_STEP_SAMPLER = None
 
 
 class Adversary:
@@ -10,64 +15,332 @@ class Adversary:
 
     :param curator: curator of the target network
     :param float eta: multiplicative weights update power (w <-- w * e^eta)
+    :param str storage: storage of the approximation network, 'dense' if None,
+                        so its uniform prior is one filled array
     :ivar curator: curator of the target network
     :ivar float eta: multiplicative weights update power (w <-- w * e^eta)
     :ivar network: the approximation network
-    :ivar tuple preference_combinations: all possible preference tuples
+    :ivar preference_combinations: lazy sequence of all possible preference tuples
     :ivar int preference_index: index of next preference tuple to pirate
     """
 
-    def __init__(self, curator, eta=1e-4):
+    def __init__(self, curator, eta=1e-4, storage=None):
         self.curator = curator
         self.eta = eta
         self.network = Network(size=self.curator.network.size,
-                               interactivity=self.curator.network.interactivity)
+                               interactivity=self.curator.network.interactivity,
+                               storage=storage or 'dense')
         self.network.make_all_links()
         self.preference_combinations = self.network.get_all_preferences()
         self.preference_index = 0
 
     @staticmethod
     def normalize(utilities):
-        """Return a list of probabilities generated by normalizing utilities
+        """Return probabilities generated by normalizing utilities
 
-        :return: list of probabilities generated by normalizing utilities
-        :rtype: list
+        Every row (last axis) of ``utilities`` is normalized independently,
+        so a whole utility matrix can be converted in one call.
+
+        :return: array of probabilities generated by normalizing utilities
+        :rtype: numpy.ndarray
         """
-        utility_sum = sum(utilities)
-        return [utility / utility_sum for utility in utilities]
+        utilities = numpy.asarray(utilities, dtype=float)
+        return utilities / utilities.sum(axis=-1, keepdims=True)
+
+    @staticmethod
+    def log_normalize(utilities):
+        """Return log probabilities generated by normalizing utilities
 
-    def pirate(self, sequence_length, number_of_queries=1):
+        :return: array of log probabilities generated by normalizing utilities
+        :rtype: numpy.ndarray
+        """
+        utilities = numpy.asarray(utilities, dtype=float)
+        with numpy.errstate(divide='ignore'):
+            return numpy.log(utilities) - numpy.log(utilities.sum(axis=-1, keepdims=True))
+
+    def pirate(self, sequence_length, number_of_queries=1, block_size=None):
         """Return a network that approximates curator's network probabilities
 
         This network's link utilities are normalized to probabilities, rather
         than fed through the exponential mechanism to obtain probabilities.
 
+        With a ``block_size``, queries are made ``block_size`` at a time with
+        Curator.query_many and applied with self.pirate_block. Otherwise,
+        queries are made one at a time; an array-backed network's traversals
+        are counted as they come and applied once, with self.apply_counts.
+
+        :param int sequence_length: length of sequences to pirate
+        :param int number_of_queries: number of times to query the curator
+        :param int block_size: number of queries per batched block, if batched
+        """
+        progress_task = 'Pirating %d sequences' % number_of_queries
+        nodes_by_name = {node.name: node for node in self.network.nodes}
+        counts = None
+        if not block_size and self.network.storage != 'links':
+            counts = numpy.zeros((self.network.interactivity, self.network.size, self.network.size), dtype=numpy.int64)
+        query_number = 0
+        with INSTRUMENTS.timer('pirate'):
+            while query_number < number_of_queries:
+                if block_size:
+                    block_queries = min(block_size, number_of_queries - query_number)
+                    preferences_batch = self.preference_combinations.get_batch(self.preference_index, block_queries)
+                    responses = self.curator.query_many(sequence_length, preferences_batch, block_queries)
+                    self.pirate_block(responses, preferences_batch)
+                else:
+                    block_queries = 1
+                    preferences = self.preference_combinations[self.preference_index]
+                    query_response = self.curator.query(sequence_length, preferences)
+                    sequence = [nodes_by_name[name] for name in query_response]
+                    if counts is not None:
+                        for i in range(len(sequence) - 1):
+                            source = sequence[i].index
+                            counts[preferences[source], source, sequence[i + 1].index] += 1
+                    else:
+                        # Update all seen links by multiplicative weights
+                        for i in range(len(sequence) - 1):
+                            node1, node2 = sequence[i], sequence[i + 1]
+                            preference = preferences[node1.index]
+                            link = node1.links[node2][preference]
+                            link.utility *= exp(self.eta)
+                query_number += block_queries
+                self.preference_index += block_queries
+                self.preference_index %= self.preference_combinations.cardinality
+                if INSTRUMENTS.enabled:
+                    if counts is None and not block_size:
+                        INSTRUMENTS.count('link_updates', len(sequence) - 1)
+                    INSTRUMENTS.progress(progress_task, query_number, number_of_queries)
+            if counts is not None:
+                self.apply_counts(counts)
+
+    def count_transitions(self, responses, preferences_batch):
+        """Return how many times each Link was traversed in a block of responses
+
+        :param responses: (queries x sequence length) array of Node.index values
+        :param preferences_batch: (queries x size) preferences of each response
+        :return: (interactivity x size x size) counts, indexed like the utility tensor
+        :rtype: numpy.ndarray
+        """
+        return transition_counts(responses, preferences_batch, self.network.interactivity, self.network.size)
+
+    def pirate_block(self, responses, preferences_batch):
+        """Update Link utilities from a block of query responses
+
+        Transitions are counted with one scatter-add, and every traversed Link
+        is then multiplied by e^(eta * count) once.
+
+        :param responses: (queries x sequence length) array of Node.index values
+        :param preferences_batch: (queries x size) preferences of each response
+        """
+        self.apply_counts(self.count_transitions(responses, preferences_batch))
+
+    def apply_counts(self, counts, normalize_rows=False):
+        """Multiply every Link utility by e^(eta * count)
+
+        With ``normalize_rows``, each (response, source) row's factors are
+        divided by the row's largest factor, so huge counts cannot overflow.
+        Normalized probabilities are unchanged, as they are per row.
+
+        :param counts: (interactivity x size x size) Link traversal counts
+        :param bool normalize_rows: whether to rescale each row's factors
+        """
+        exponents = self.eta * numpy.asarray(counts, dtype=float)
+        if normalize_rows:
+            exponents -= exponents.max(axis=-1, keepdims=True)
+        responses, sources, destinations = numpy.nonzero(exponents)
+        INSTRUMENTS.count('link_updates', len(responses))
+        if self.network.storage == 'dense':
+            self.network.utilities *= numpy.exp(exponents)
+            for response, source in set(zip(responses.tolist(), sources.tolist())):
+                self.network.nodes[source].touch(response)
+            return
+        nodes = self.network.nodes
+        for response, source, destination in zip(responses.tolist(), sources.tolist(), destinations.tolist()):
+            link = nodes[source].links[nodes[destination]][response]
+            link.utility *= exp(exponents[response, source, destination])
+
+    def pirate_sharded(self, sequence_length, number_of_queries=1, shards=8, processes=None, seed=0,
+                       block_size=10000):
+        """Pirate with the queries split into shards, run across worker processes
+
+        Shard s makes a contiguous share of the queries, so it also covers a
+        contiguous range of self.preference_combinations, and draws from a
+        generator seeded by (seed, s) alone. Each shard returns its Link
+        traversal counts, eta times which are its log weights; as multiplicative
+        weights add in log space, summing the integer counts merges the shards
+        exactly, and they are then applied once. The result depends on the
+        seed and number of shards, not on the number of processes: it matches
+        the serial run pirate_sharded(processes=1) with the same seed and
+        shards, not self.pirate, which draws from other generators.
+
+        The curator's step sampler is sent to each worker process once, by
+        the pool initializer, rather than with every shard.
+
+        :param int sequence_length: length of sequences to pirate
+        :param int number_of_queries: number of times to query the curator
+        :param int shards: number of shards to split the queries into
+        :param int processes: number of worker processes, all cores if None, in this process if 1
+        :param int seed: seed of the shard generators
+        :param int block_size: number of queries sampled at once within a shard
+        :return: (interactivity x size x size) merged Link traversal counts
+        :rtype: numpy.ndarray
+        """
+        step_sampler = self.curator.get_step_sampler()
+        shard_starts = [number_of_queries * shard // shards for shard in range(shards + 1)]
+        arguments = [(self.preference_combinations, self.network.interactivity, sequence_length,
+                      self.preference_index + shard_starts[shard], shard_starts[shard + 1] - shard_starts[shard],
+                      block_size, seed, shard)
+                     for shard in range(shards)]
+        with INSTRUMENTS.timer('pirate_sharded'):
+            if processes == 1:
+                set_shard_step_sampler(step_sampler)
+                try:
+                    shard_counts = [pirate_shard(shard_arguments) for shard_arguments in arguments]
+                finally:
+                    set_shard_step_sampler(None)
+            else:
+                with multiprocessing.Pool(processes, set_shard_step_sampler, (step_sampler,)) as pool:
+                    shard_counts = pool.map(pirate_shard, arguments)
+            counts = self.merge_shards(shard_counts)
+            self.apply_counts(counts)
+        INSTRUMENTS.count('queries', number_of_queries)
+        INSTRUMENTS.count('steps', number_of_queries * (sequence_length - 1))
+        self.preference_index += number_of_queries
+        self.preference_index %= self.preference_combinations.cardinality
+        return counts
+
+    def merge_shards(self, shard_counts):
+        """Return the sum of shards' Link traversal counts
+
+        :param list shard_counts: (interactivity x size x size) counts of each shard
+        :rtype: numpy.ndarray
+        """
+        counts = numpy.zeros((self.network.interactivity, self.network.size, self.network.size), dtype=numpy.int64)
+        for counts_of_shard in shard_counts:
+            counts += counts_of_shard
+        return counts
+
+    def expected_counts(self, sequence_length, number_of_queries=1, batch_size=1024):
+        """Return the expected Link traversal counts of pirating, in closed form
+
+        Queries cycle through self.preference_combinations from
+        self.preference_index, so each preference tuple c is queried a known
+        number of times w_c. A query under c starts uniformly at random and
+        visits node i at step t with probability pi_t(i) = (pi_0 T_c^t)(i),
+        so Link (r, i, j) is expected to be traversed
+        sum_c w_c [c_i = r] sum_{t < length - 1} pi_t(i) P_r(i, j) times, where
+        P_r holds the curator's exponential mechanism probabilities.
+
+        The cost is O(min(queries, preference tuples) * length * size^2),
+        whatever the number of queries.
+
         :param int sequence_length: length of sequences to pirate
         :param int number_of_queries: number of times to query the curator
+        :param int batch_size: number of preference tuples propagated at once
+        :return: (interactivity x size x size) expected Link traversal counts
+        :rtype: numpy.ndarray
+        """
+        curator_network = self.curator.network
+        size, interactivity = curator_network.size, curator_network.interactivity
+        probabilities = self.curator.exponential_mechanism(curator_network.get_utility_tensor())
+        cardinality = self.preference_combinations.cardinality
+        full_cycles, remainder = divmod(number_of_queries, cardinality)
+        visited = min(number_of_queries, cardinality)
+        occupancies = numpy.zeros((interactivity, size))
+        for batch_start in range(0, visited, batch_size):
+            batch_count = min(batch_size, visited - batch_start)
+            preferences_batch = self.preference_combinations.get_batch(self.preference_index + batch_start,
+                                                                       batch_count)
+            weights = full_cycles + (batch_start + numpy.arange(batch_count) < remainder)
+            response_masks = [preferences_batch == response for response in range(interactivity)]
+            distributions = numpy.full((batch_count, size), 1.0 / size)
+            batch_occupancies = numpy.zeros((batch_count, size))
+            for sequence_step in range(sequence_length - 1):
+                batch_occupancies += distributions
+                # Each tuple's step splits by the response at each node, so no
+                # per-tuple transition matrix is ever built
+                next_distributions = numpy.zeros((batch_count, size))
+                for response in range(interactivity):
+                    next_distributions += (distributions * response_masks[response]) @ probabilities[response]
+                distributions = next_distributions
+            for response in range(interactivity):
+                occupancies[response] += weights @ (response_masks[response] * batch_occupancies)
+        return probabilities * occupancies[:, :, numpy.newaxis]
+
+    def expect(self, sequence_length, number_of_queries=1, variance=False):
+        """Update Link utilities by the expected result of pirating, in closed form
+
+        Instead of sampling the curator, every Link is multiplied by
+        e^(eta * expected count), with rows rescaled against overflow. A single
+        query traverses a Link at most length - 1 times, so the variance of
+        each count is at most (length - 1) times its expectation.
+
+        :param int sequence_length: length of sequences to pirate
+        :param int number_of_queries: number of times the curator would be queried
+        :param bool variance: whether to also return the count variance bounds
+        :return: expected Link traversal counts, and their variance bounds if asked
+        :rtype: numpy.ndarray or tuple
         """
-        progress_bar_prefix = 'Pirating %d sequences' % number_of_queries
-        progress_bar_progress = 0
-        progress_bar_size = 76 - len(progress_bar_prefix)
-        if PRINT:
-            print(progress_bar_prefix + ' |' + ' ' * progress_bar_size + '|', end='\r')
-        for query_number in range(number_of_queries):
-            if query_number / number_of_queries > progress_bar_progress / progress_bar_size:
-                progress_bar_progress += 1
-                if PRINT:
-                    print(progress_bar_prefix + ' |' +
-                          '-' * progress_bar_progress +
-                          ' ' * (progress_bar_size - progress_bar_progress) + '|', end='\r')
-            preferences = self.preference_combinations[self.preference_index]
-            query_response = self.curator.query(sequence_length, preferences)
-            sequence = [node for node in self.network.nodes for name in query_response
-                        if node.name == name]
-            # Update all seen links by multiplicative weights
-            for i in range(len(sequence) - 1):
-                node1, node2 = sequence[i], sequence[i + 1]
-                preference = preferences[self.network.nodes.index(node1)]
-                link = node1.links[node2][preference]
-                link.utility *= exp(self.eta)
-            self.preference_index += 1
-            self.preference_index %= len(self.preference_combinations)
-        if PRINT:
-            print('' + progress_bar_prefix + ' |' + '-' * progress_bar_size + '|')
+        with INSTRUMENTS.timer('expect'):
+            counts = self.expected_counts(sequence_length, number_of_queries)
+            self.apply_counts(counts, normalize_rows=True)
+        self.preference_index += number_of_queries
+        self.preference_index %= self.preference_combinations.cardinality
+        if variance:
+            return counts, (sequence_length - 1) * counts
+        return counts
+
+
+def transition_counts(responses, preferences_batch, interactivity, size):
+    """Return how many times each Link was traversed in a block of responses
+
+    :param responses: (queries x sequence length) array of Node.index values
+    :param preferences_batch: (queries x size) preferences of each response
+    :param int interactivity: number of responses per Node
+    :param int size: number of Nodes
+    :return: (interactivity x size x size) counts, indexed like the utility tensor
+    :rtype: numpy.ndarray
+    """
+    responses = numpy.asarray(responses, dtype=int)
+    preferences_batch = numpy.asarray(preferences_batch, dtype=int)
+    sources, destinations = responses[:, :-1], responses[:, 1:]
+    responses_preferences = numpy.take_along_axis(preferences_batch, sources, axis=1)
+    link_numbers = (responses_preferences * size + sources) * size + destinations
+    counts = numpy.bincount(link_numbers.ravel(), minlength=interactivity * size * size)
+    return counts.reshape(interactivity, size, size)
+
+
+def set_shard_step_sampler(step_sampler):
+    """Set the step sampler of the shards run in this process
+
+    :param step_sampler: StepSampler or SparseStepSampler of the curator, or None
+    """
+    global SHARD_STEP_SAMPLER
+    SHARD_STEP_SAMPLER = step_sampler
+
+
+def pirate_shard(arguments):
+    """Return the Link traversal counts of one shard of Adversary.pirate_sharded
+
+    Queries are sampled from SHARD_STEP_SAMPLER (see set_shard_step_sampler).
+    The global numpy.random generator is seeded for the shard, and restored
+    afterwards.
+
+    :param tuple arguments: preference space, interactivity, sequence length,
+                            first preference index, number of queries, block
+                            size, seed and shard number
+    :return: (interactivity x size x size) Link traversal counts
+    :rtype: numpy.ndarray
+    """
+    (preference_combinations, interactivity, sequence_length,
+     preference_index, number_of_queries, block_size, seed, shard) = arguments
+    step_sampler = SHARD_STEP_SAMPLER
+    state = numpy.random.get_state()
+    numpy.random.seed(numpy.random.SeedSequence([seed, shard]).generate_state(1)[0])
+    counts = numpy.zeros((interactivity, step_sampler.size, step_sampler.size), dtype=numpy.int64)
+    for block_start in range(0, number_of_queries, block_size):
+        block_queries = min(block_size, number_of_queries - block_start)
+        preferences_batch = preference_combinations.get_batch(preference_index + block_start, block_queries)
+        responses = sample_sequences(step_sampler, sequence_length, preferences_batch, block_queries)
+        counts += transition_counts(responses, preferences_batch, interactivity, step_sampler.size)
+    numpy.random.set_state(state)
+    return counts
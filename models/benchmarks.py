@@ -0,0 +1,228 @@
+from adversaries import Adversary
+from curators import Curator
+from databases import Network
+from metrics import kl_divergence, rank_correlation, top_sequences_errors, total_variation
+from itertools import product
+import argparse
+import json
+import numpy
+import random
+import sys
+import time
+import tracemalloc
+
+
+GRID = {'size': (10, 40), 'interactivity': (2, 4), 'density': (0.1, 0.5),
+        'sequence_length': (3, 5), 'storage': ('links', 'dense', 'sparse')}
+QUICK_GRID = {'size': (8,), 'interactivity': (2,), 'density': (0.3,),
+              'sequence_length': (3,), 'storage': ('links', 'dense', 'sparse')}
+QUERIES = 200
+# Benchmarks enumerating every sequence skip cells with more sequences than this
+MAX_SEQUENCES = 2 ** 24
+ENUMERATING_BENCHMARKS = ('sequence_probabilities', 'metrics')
+
+
+def make_curator(cell):
+    """Return a curator of a random network for a benchmark cell
+
+    :param dict cell: size, interactivity, density and storage
+    :rtype: Curator
+    """
+    curator = Curator()
+    curator.network = Network(cell['size'], cell['interactivity'], storage=cell['storage'])
+    curator.network.make_random_links(density=cell['density'])
+    return curator
+
+
+def benchmark_make_random_links(cell):
+    """Time drawing random Links for a whole network
+    """
+    network = Network(cell['size'], cell['interactivity'], storage=cell['storage'])
+    return lambda: network.make_random_links(density=cell['density']), 1, 'networks'
+
+
+def benchmark_query(cell):
+    """Time single-stream Curator.query calls
+    """
+    curator = make_curator(cell)
+    preferences = curator.network.get_random_preferences()
+
+    def run():
+        for _ in range(QUERIES):
+            curator.query(cell['sequence_length'], preferences)
+    return run, QUERIES, 'queries'
+
+
+def benchmark_query_many(cell):
+    """Time one batched Curator.query_many call
+    """
+    curator = make_curator(cell)
+    preferences = curator.network.get_random_preferences()
+    return lambda: curator.query_many(cell['sequence_length'], preferences, 100 * QUERIES), 100 * QUERIES, 'queries'
+
+
+def benchmark_pirate(cell):
+    """Time per-query Adversary.pirate
+    """
+    adversary = Adversary(make_curator(cell))
+    return lambda: adversary.pirate(cell['sequence_length'], number_of_queries=QUERIES), QUERIES, 'queries'
+
+
+def benchmark_pirate_block(cell):
+    """Time batched Adversary.pirate
+    """
+    adversary = Adversary(make_curator(cell))
+    return (lambda: adversary.pirate(cell['sequence_length'], number_of_queries=100 * QUERIES, block_size=QUERIES),
+            100 * QUERIES, 'queries')
+
+
+def benchmark_sequence_probabilities(cell):
+    """Time computing every sequence probability
+    """
+    curator = make_curator(cell)
+    preferences = curator.network.get_random_preferences()
+    return (lambda: curator.network.sequence_probabilities(preferences, cell['sequence_length'],
+                                                           curator.exponential_mechanism),
+            cell['size'] ** cell['sequence_length'], 'sequences')
+
+
+def benchmark_metrics(cell):
+    """Time the reconstruction metrics
+    """
+    curator = make_curator(cell)
+    adversary = Adversary(curator)
+    adversary.pirate(cell['sequence_length'], number_of_queries=QUERIES, block_size=QUERIES)
+    preferences = curator.network.get_random_preferences()
+    curator_probabilities = curator.network.sequence_probabilities(preferences, cell['sequence_length'],
+                                                                   curator.exponential_mechanism)
+    adversary_probabilities = adversary.network.sequence_probabilities(preferences, cell['sequence_length'],
+                                                                       Adversary.normalize)
+
+    def run():
+        kl_divergence(curator_probabilities, adversary_probabilities)
+        total_variation(curator_probabilities, adversary_probabilities)
+        rank_correlation(curator_probabilities, adversary_probabilities)
+        top_sequences_errors(curator_probabilities, adversary_probabilities, (0.1, 0.5))
+    return run, len(curator_probabilities), 'sequences'
+
+
+BENCHMARKS = {'make_random_links': benchmark_make_random_links,
+              'query': benchmark_query,
+              'query_many': benchmark_query_many,
+              'pirate': benchmark_pirate,
+              'pirate_block': benchmark_pirate_block,
+              'sequence_probabilities': benchmark_sequence_probabilities,
+              'metrics': benchmark_metrics}
+
+
+def measure(benchmark, cell, repeats=3):
+    """Return the best throughput and the peak memory of one benchmark cell
+
+    Each benchmark function sets up its cell and returns the function to time,
+    its number of work items and their unit. Timing runs are made without
+    tracemalloc, then one more run measures the peak traced memory.
+
+    :param str benchmark: name in BENCHMARKS
+    :param dict cell: size, interactivity, density, sequence_length and storage
+    :param int repeats: number of timing runs, of which the fastest is kept
+    :return: result row of the cell
+    :rtype: dict
+    """
+    random.seed(0)
+    numpy.random.seed(0)
+    run, items, unit = BENCHMARKS[benchmark](cell)
+    seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    row = dict(benchmark=benchmark, **cell)
+    row.update(seconds=seconds, throughput=items / seconds if seconds else float('inf'),
+               unit=unit, peak_bytes=peak_bytes)
+    return row
+
+
+def run_benchmarks(grid, benchmarks=None, repeats=3):
+    """Return result rows of every benchmark over every cell of a grid
+
+    Cells with more than MAX_SEQUENCES sequences are skipped by the
+    benchmarks that enumerate every sequence.
+
+    :param dict grid: parameter names keying to tuples of values
+    :param list benchmarks: names in BENCHMARKS, all if None
+    :param int repeats: number of timing runs per cell
+    :rtype: list
+    """
+    rows = []
+    for benchmark in benchmarks or sorted(BENCHMARKS):
+        for values in product(*grid.values()):
+            cell = dict(zip(grid, values))
+            if benchmark in ENUMERATING_BENCHMARKS and cell['size'] ** cell['sequence_length'] > MAX_SEQUENCES:
+                continue
+            rows.append(measure(benchmark, cell, repeats))
+    return rows
+
+
+def row_key(row):
+    """Return the benchmark and parameters identifying a result row
+
+    :rtype: tuple
+    """
+    return tuple((key, row[key]) for key in ['benchmark'] + sorted(GRID) if key in row)
+
+
+def find_regressions(rows, baseline_rows, tolerance=0.2):
+    """Return descriptions of rows slower or bigger than their baseline rows
+
+    :param list rows: new result rows
+    :param list baseline_rows: baseline result rows
+    :param float tolerance: allowed fractional throughput loss or memory gain
+    :rtype: list
+    """
+    baseline = {row_key(row): row for row in baseline_rows}
+    regressions = []
+    for row in rows:
+        if row_key(row) not in baseline:
+            continue
+        old_row = baseline[row_key(row)]
+        name = ', '.join('%s=%s' % item for item in row_key(row))
+        if row['throughput'] < (1 - tolerance) * old_row['throughput']:
+            regressions.append('%s: %.4g %s/s, baseline %.4g' %
+                               (name, row['throughput'], row['unit'], old_row['throughput']))
+        if row['peak_bytes'] > (1 + tolerance) * old_row['peak_bytes']:
+            regressions.append('%s: %d peak bytes, baseline %d' % (name, row['peak_bytes'], old_row['peak_bytes']))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark curator, adversary and network hot paths')
+    parser.add_argument('--output', default='benchmarks.json', help='result file to write')
+    parser.add_argument('--baseline', help='result file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fractional regression')
+    parser.add_argument('--benchmark', action='append', choices=sorted(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('--repeats', type=int, default=3, help='timing runs per cell')
+    parser.add_argument('--quick', action='store_true', help='use a small grid')
+    arguments = parser.parse_args(arguments)
+
+    rows = run_benchmarks(QUICK_GRID if arguments.quick else GRID, arguments.benchmark, arguments.repeats)
+    for row in rows:
+        print('%-24s %s  %12.4g %s/s  %12d peak bytes' %
+              (row['benchmark'], ' '.join('%s=%s' % item for item in row_key(row)[1:]),
+               row['throughput'], row['unit'], row['peak_bytes']))
+    with open(arguments.output, 'w') as output_file:
+        json.dump({'results': rows}, output_file, indent=1)
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            regressions = find_regressions(rows, json.load(baseline_file)['results'], arguments.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+from databases import Network
+import hashlib
+import json
+import numpy
+import os
+import shutil
+import tempfile
+
+
+CURRENT = None
+# Modules whose code determines cached results; scripts, benchmarks and
+# front ends are left out so editing them keeps the cache
+CODE_MODULES = ('adversaries', 'caches', 'curators', 'databases', 'experiments', 'metrics')
+_code_versions = {}
+
+
+def get_code_version(modules=CODE_MODULES):
+    """Return a hash of the modules' sources, so cached results expire with the code
+
+    :param modules: names of modules in models/ to hash
+    :rtype: str
+    """
+    modules = tuple(sorted(modules))
+    if modules not in _code_versions:
+        code_hash = hashlib.sha256()
+        for module in modules:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module + '.py'), 'rb') as source_file:
+                code_hash.update(module.encode() + b'\0' + source_file.read())
+        _code_versions[modules] = code_hash.hexdigest()
+    return _code_versions[modules]
+
+
+def to_builtin(value):
+    """Return a numpy scalar or array as a JSON-serializable value
+    """
+    if isinstance(value, (numpy.generic, numpy.ndarray)):
+        return value.tolist()
+    raise TypeError('cannot serialize %r' % (value,))
+
+
+class ResultCache:
+    """On-disk memoization of results, keyed by a hash of their configuration and the code
+
+    Results are stored by kind: arrays as .npy files, Networks as
+    Network.save directories, and anything JSON-serializable, such as sweep
+    rows, as .json files. Every lookup marks its entry as used, and storing
+    evicts the least recently used entries until the cache fits ``max_bytes``.
+
+    :param str directory: directory of the cache, created if needed
+    :param int max_bytes: largest total size of the cache
+    :param code_modules: names of modules whose code versions results, CODE_MODULES by default
+    :ivar str directory: directory of the cache
+    :ivar int max_bytes: largest total size of the cache
+    :ivar tuple code_modules: names of modules whose code versions results
+    :ivar int hits: lookups served from the cache
+    :ivar int misses: lookups that had to compute their result
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30, code_modules=CODE_MODULES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.code_modules = tuple(code_modules)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, config):
+        """Return the hash of a configuration and the code version
+
+        :param dict config: JSON-serializable configuration
+        :rtype: str
+        """
+        text = json.dumps({'config': config, 'code': get_code_version(self.code_modules)}, sort_keys=True,
+                          default=to_builtin)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get_path(self, key):
+        """Return the path of a key's entry, or None if it is not cached
+
+        :param str key: hash of a configuration
+        :rtype: str
+        """
+        for extension in ('.npy', '.json', '.network'):
+            path = os.path.join(self.directory, key + extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def load(self, key):
+        """Return the result cached for a key, marking it as used
+
+        :param str key: hash of a configuration
+        :raises KeyError: if the key is not cached
+        """
+        path = self.get_path(key)
+        if path is None:
+            raise KeyError(key)
+        os.utime(path)
+        if path.endswith('.npy'):
+            return numpy.load(path)
+        if path.endswith('.network'):
+            return Network.load(path, mmap_mode=None)
+        with open(path) as entry_file:
+            return json.load(entry_file)
+
+    def store(self, key, value):
+        """Cache a result for a key, then evict entries beyond self.max_bytes
+
+        Entries are written under a temporary name and renamed into place, so
+        concurrent readers never see a partial entry. Errors are raised unless
+        another process has already stored the key.
+
+        :param str key: hash of a configuration
+        :param value: array, Network, or JSON-serializable result
+        :raises OSError: if the entry could not be stored
+        """
+        if isinstance(value, Network):
+            path = os.path.join(self.directory, key + '.network')
+        elif isinstance(value, numpy.ndarray):
+            path = os.path.join(self.directory, key + '.npy')
+        else:
+            path = os.path.join(self.directory, key + '.json')
+        temporary_path = tempfile.mkdtemp(dir=self.directory, prefix='.')
+        try:
+            if isinstance(value, Network):
+                value.save(temporary_path)
+                os.replace(temporary_path, path)
+            else:
+                temporary_file = os.path.join(temporary_path, 'entry' + os.path.splitext(path)[1])
+                if isinstance(value, numpy.ndarray):
+                    numpy.save(temporary_file, value)
+                else:
+                    with open(temporary_file, 'w') as entry_file:
+                        json.dump(value, entry_file, default=to_builtin)
+                os.replace(temporary_file, path)
+        except OSError:
+            # Only another process having stored the same key first is harmless
+            if not os.path.exists(path):
+                raise
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        self.evict()
+
+    def get_or_compute(self, config, compute):
+        """Return the result cached for a configuration, computing and caching it if missing
+
+        :param dict config: JSON-serializable configuration
+        :param compute: function of no arguments returning the result
+        """
+        key = self.get_key(config)
+        try:
+            value = self.load(key)
+            self.hits += 1
+            return value
+        except KeyError:
+            self.misses += 1
+        value = compute()
+        self.store(key, value)
+        return value
+
+    def get_entries(self):
+        """Return (last use time, bytes, path) of every entry
+
+        :rtype: list
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                size = sum(os.path.getsize(os.path.join(entry.path, name)) for name in os.listdir(entry.path))
+            else:
+                size = entry.stat().st_size
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits self.max_bytes
+        """
+        entries = sorted(self.get_entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+            total_bytes -= size
+
+
+def set_cache(cache):
+    """Set the cache used by cached, None to compute every result
+
+    :param ResultCache cache: cache to use
+    """
+    global CURRENT
+    CURRENT = cache
+
+
+def cached(config, compute):
+    """Return compute(), memoized in the current cache if there is one
+
+    :param dict config: JSON-serializable configuration identifying the result
+    :param compute: function of no arguments returning the result
+    """
+    if CURRENT is None:
+        return compute()
+    return CURRENT.get_or_compute(config, compute)
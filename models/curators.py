@@ -1,27 +1,67 @@
+from bisect import bisect_right
+from instruments import INSTRUMENTS
 import numpy
 import random
 
 
+# Bytes of cumulative probabilities per StepSampler block
+BLOCK_BYTES = 2 ** 20
+
+
 class Curator:
     """Database curator that creates and queries databases for analysts
 
     :param float epsilon: privacy parameter
+    :param dtype: floating point type of exponential mechanism probabilities
     :ivar float epsilon: privacy parameter
+    :ivar dtype: floating point type of exponential mechanism probabilities
     :ivar network: private content network
+    :ivar dict alias_tables: (Node, response) keying to (version, AliasTable)
+    :ivar int alias_table_hits: alias table lookups served from the cache
+    :ivar int alias_table_misses: alias table lookups that built a new table
+    :ivar int alias_table_rebuilds: alias table lookups that rebuilt a stale table
+    :ivar tuple step_sampler_cache: (network, epsilon, dtype, Node versions, sampler) of the last step sampler
+    :ivar int step_sampler_hits: step sampler lookups served from the cache
+    :ivar int step_sampler_misses: step sampler lookups that built a new sampler
+    :ivar int step_sampler_rebuilds: step sampler lookups that rebuilt edited rows
     """
 
-    def __init__(self, epsilon=100):
+    def __init__(self, epsilon=100, dtype=numpy.float64):
         self.epsilon = epsilon
+        self.dtype = dtype
         self.network = None
+        self.alias_tables = {}
+        self.alias_table_hits = 0
+        self.alias_table_misses = 0
+        self.alias_table_rebuilds = 0
+        self.step_sampler_cache = None
+        self.step_sampler_hits = 0
+        self.step_sampler_misses = 0
+        self.step_sampler_rebuilds = 0
 
     def exponential_mechanism(self, utilities):
-        """Return a list of probabilities generated from the utilities
+        """Return probabilities generated from the utilities
 
-        :return: list of probabilities generated from the utilities
-        :rtype: list
+        Every row (last axis) of ``utilities`` is converted independently,
+        so a whole utility matrix can be converted in one call.
+
+        :return: array of probabilities generated from the utilities
+        :rtype: numpy.ndarray
+        """
+        return numpy.exp(self.log_exponential_mechanism(utilities))
+
+    def log_exponential_mechanism(self, utilities):
+        """Return log probabilities generated from the utilities
+
+        Each row's log weights 0.5 * epsilon * u are shifted by their maximum
+        before the log-sum-exp normalization, so no weight can overflow.
+
+        :return: array of log probabilities generated from the utilities
+        :rtype: numpy.ndarray
         """
-        weights = numpy.exp(0.5 * self.epsilon * numpy.array(utilities))
-        return list(weights / sum(weights))
+        log_weights = 0.5 * self.epsilon * numpy.asarray(utilities, dtype=self.dtype)
+        log_weights -= log_weights.max(axis=-1, keepdims=True)
+        return log_weights - numpy.log(numpy.exp(log_weights).sum(axis=-1, keepdims=True))
 
     def query(self, sequence_length, preferences):
         """Return a list of nodes picked with the exponential mechanism
@@ -33,6 +73,10 @@ class Curator:
 
         The first node is always the first node in self.network.nodes.
 
+        Each step reads the live network, so a query is not safe while another
+        thread edits it; query a NetworkSnapshot (see NetworkSnapshots)
+        instead.
+
         :param int sequence_length: length of sequence to query
         :param tuple preferences: user input at each node in self.network.nodes
         :return: list of nodes picked with the exponential mechanism
@@ -41,20 +85,363 @@ class Curator:
         sequence = [random.choice(self.network.nodes)]
         for sequence_step in range(sequence_length - 1):
             this_node = sequence[-1]
-            this_index = self.network.nodes.index(this_node)
-            utilities = [0 if (node not in this_node.links
-                               or preferences[this_index] not in this_node.links[node])
-                         else this_node.links[node][preferences[this_index]].utility
-                         for node in self.network.nodes]
-            probabilities = self.exponential_mechanism(utilities)
-            shuffled_probabilities = probabilities[:]
-            random.shuffle(shuffled_probabilities)
-            next_probability = numpy.random.choice(shuffled_probabilities,
-                                                   p=shuffled_probabilities)
-            # In case of equal probabilities, eliminate earlier-in-list bias
-            next_probability_indices = [i for i, x in enumerate(probabilities)
-                                        if x == next_probability]
-            next_node_index = random.choice(next_probability_indices)
-            next_node = self.network.nodes[next_node_index]
-            sequence.append(next_node)
+            alias_table = self.get_alias_table(this_node, preferences[this_node.index])
+            sequence.append(self.network.nodes[alias_table.draw()])
+        INSTRUMENTS.count('queries')
+        INSTRUMENTS.count('steps', sequence_length - 1)
         return [node.name for node in sequence]
+
+    def get_alias_table(self, node, response):
+        """Return the alias table of the exponential mechanism leaving node
+
+        Tables are cached per (node, response) and rebuilt lazily once
+        self.epsilon changes or a Link leaving node for response is edited.
+
+        :param node: source Node
+        :param int response: user input at node
+        :return: alias table over the Node.index of the next node
+        :rtype: AliasTable or SparseAliasTable
+        """
+        version = (self.epsilon, node.versions.get(response, 0))
+        try:
+            cached_version, alias_table = self.alias_tables[(node, response)]
+        except KeyError:
+            self.alias_table_misses += 1
+        else:
+            if cached_version == version:
+                self.alias_table_hits += 1
+                return alias_table
+            self.alias_table_rebuilds += 1
+        if self.network.storage == 'sparse':
+            row = response * self.network.size + node.index
+            link_probabilities, undefined_probabilities = self.network.get_link_probabilities(
+                self.exponential_mechanism, range(row, row + 1))
+            destinations = self.network.link_destinations[self.network.get_row_slice(response, node.index)]
+            alias_table = SparseAliasTable(link_probabilities, undefined_probabilities[0],
+                                           destinations, self.network.size)
+        else:
+            utilities = self.network.get_link_utilities(node, response)
+            alias_table = AliasTable(self.exponential_mechanism(utilities))
+        self.alias_tables[(node, response)] = (version, alias_table)
+        return alias_table
+
+    def get_cumulative_probabilities(self):
+        """Return cumulative exponential mechanism probabilities for every Link
+
+        Entry [response, source, destination] is the probability of stepping
+        from source to any Node up to destination, given the response at source.
+
+        :return: (interactivity x size x size) cumulative probabilities
+        :rtype: numpy.ndarray
+        """
+        probabilities = self.exponential_mechanism(self.network.get_utility_tensor())
+        cumulative_probabilities = numpy.cumsum(probabilities, axis=-1, dtype=numpy.float64)
+        cumulative_probabilities[..., -1] = 1
+        return cumulative_probabilities
+
+    def get_row_cumulative_probabilities(self, rows):
+        """Return cumulative exponential mechanism probabilities for some rows
+
+        :param rows: array of row numbers, response * size + source
+        :return: (rows x size) cumulative probabilities
+        :rtype: numpy.ndarray
+        """
+        responses, sources = numpy.divmod(numpy.asarray(rows, dtype=int), self.network.size)
+        utilities = numpy.array([self.network.get_link_utilities(self.network.nodes[source], response)
+                                 for response, source in zip(responses.tolist(), sources.tolist())])
+        cumulative_probabilities = numpy.cumsum(self.exponential_mechanism(utilities.reshape(-1, self.network.size)),
+                                                axis=-1, dtype=numpy.float64)
+        cumulative_probabilities[:, -1] = 1
+        return cumulative_probabilities
+
+    def get_step_sampler(self):
+        """Return a sampler of the next node from every (node, response) at once
+
+        The sampler is cached, as the alias tables are, until the network,
+        self.epsilon or self.dtype change. Up to self.network.size edited rows
+        (see Node.touch) of a dense or links network are rebuilt alone; a
+        sparse network's sampler, or more edited rows, are rebuilt whole.
+
+        :rtype: StepSampler or SparseStepSampler
+        """
+        nodes = self.network.nodes
+        if self.step_sampler_cache is not None:
+            network, epsilon, dtype, node_versions, step_sampler = self.step_sampler_cache
+            if network is self.network and epsilon == self.epsilon and dtype == self.dtype:
+                size = self.network.size
+                rows = sorted(response * size + node.index
+                              for node, versions in zip(nodes, node_versions) if node.versions != versions
+                              for response, version in node.versions.items() if versions.get(response, 0) != version)
+                if not rows:
+                    self.step_sampler_hits += 1
+                    return step_sampler
+                # Rebuilding many rows one by one is slower than rebuilding them all
+                if self.network.storage != 'sparse' and len(rows) <= len(node_versions):
+                    self.step_sampler_rebuilds += 1
+                    step_sampler = step_sampler.replace_rows(rows, self.get_row_cumulative_probabilities(rows))
+                    self.step_sampler_cache = (self.network, self.epsilon, self.dtype,
+                                               [dict(node.versions) for node in nodes], step_sampler)
+                    return step_sampler
+        self.step_sampler_misses += 1
+        if self.network.storage == 'sparse':
+            link_probabilities, undefined_probabilities = self.network.get_link_probabilities(
+                self.exponential_mechanism)
+            step_sampler = SparseStepSampler(self.network.row_offsets, self.network.link_destinations,
+                                             link_probabilities, undefined_probabilities, self.network.size)
+        else:
+            step_sampler = StepSampler(self.get_cumulative_probabilities())
+        self.step_sampler_cache = (self.network, self.epsilon, self.dtype, [dict(node.versions) for node in nodes],
+                                   step_sampler)
+        return step_sampler
+
+    def query_many(self, sequence_length, preferences_batch, n):
+        """Return an array of n sequences of node ids picked in lockstep
+
+        Every stream steps at once by inverse-CDF sampling over the cumulative
+        exponential mechanism probabilities, which are computed once per call
+        (see self.get_step_sampler).
+        Stream i uses preferences_batch[i % len(preferences_batch)].
+
+        As in self.query, the first node of each stream is uniformly random,
+        and the live network is read, so query a NetworkSnapshot while another
+        thread edits it.
+
+        :param int sequence_length: length of sequences to query
+        :param preferences_batch: preference tuple, or sequence of preference tuples
+        :param int n: number of sequences to query
+        :return: (n x sequence_length) array of Node.index values
+        :rtype: numpy.ndarray
+        """
+        with INSTRUMENTS.timer('query_many'):
+            sequences = sample_sequences(self.get_step_sampler(), sequence_length, preferences_batch, n)
+        INSTRUMENTS.count('queries', n)
+        INSTRUMENTS.count('steps', n * (sequence_length - 1))
+        return sequences
+
+
+class StepSampler:
+    """Inverse-CDF sampler of next nodes, for many rows of probabilities at once
+
+    Rows are numbered response * size + source, and held in blocks of
+    block_rows rows. Offsetting every row by its row number within its block
+    keeps each flattened block sorted, so one searchsorted call per block
+    samples a different row for every draw. Blocks are never written once
+    built: self.replace_rows copies only the blocks it edits and shares the
+    rest, so samplers derived from one another cost little memory.
+
+    :param cumulative_probabilities: (interactivity x size x size) cumulative probabilities
+    :param int block_rows: rows per block, about BLOCK_BYTES worth if None
+    :ivar int size: number of Nodes
+    :ivar int block_rows: rows per block
+    :ivar list blocks: flattened, row-offset cumulative probabilities of each block
+    """
+
+    def __init__(self, cumulative_probabilities, block_rows=None):
+        self.size = cumulative_probabilities.shape[-1]
+        self.block_rows = block_rows or max(1, BLOCK_BYTES // (8 * self.size))
+        table = cumulative_probabilities.reshape(-1, self.size)
+        self.blocks = []
+        for block_start in range(0, len(table), self.block_rows):
+            block = table[block_start:block_start + self.block_rows]
+            self.blocks.append((block + numpy.arange(len(block))[:, numpy.newaxis]).ravel())
+
+    def sample(self, rows, draws):
+        """Return the next Node.index for each row, given uniform draws
+
+        :param rows: array of row numbers
+        :param draws: array of uniform draws on [0, 1)
+        :return: array of Node.index values
+        :rtype: numpy.ndarray
+        """
+        if len(self.blocks) == 1:
+            positions = numpy.searchsorted(self.blocks[0], draws + rows, side='right')
+            return numpy.minimum(positions - rows * self.size, self.size - 1)
+        block_numbers, block_rows = numpy.divmod(rows, self.block_rows)
+        order = numpy.argsort(block_numbers, kind='stable')
+        group_starts = numpy.flatnonzero(numpy.diff(block_numbers[order])) + 1
+        next_nodes = numpy.empty(len(rows), dtype=int)
+        for group in numpy.split(order, group_starts):
+            if not len(group):
+                continue
+            group_rows = block_rows[group]
+            positions = numpy.searchsorted(self.blocks[block_numbers[group[0]]], draws[group] + group_rows,
+                                           side='right')
+            next_nodes[group] = numpy.minimum(positions - group_rows * self.size, self.size - 1)
+        return next_nodes
+
+    def replace_rows(self, rows, cumulative_probabilities):
+        """Return a copy of this sampler with some rows' probabilities replaced
+
+        Only the blocks holding the given rows are copied; the others are
+        shared, and this sampler is left unchanged.
+
+        :param rows: array of row numbers
+        :param cumulative_probabilities: (rows x size) new cumulative probabilities
+        :rtype: StepSampler
+        """
+        rows = numpy.asarray(rows, dtype=int)
+        step_sampler = StepSampler.__new__(StepSampler)
+        step_sampler.size = self.size
+        step_sampler.block_rows = self.block_rows
+        step_sampler.blocks = list(self.blocks)
+        block_numbers, block_rows = numpy.divmod(rows, self.block_rows)
+        for block_number in numpy.unique(block_numbers).tolist():
+            edited = block_numbers == block_number
+            block = self.blocks[block_number].copy().reshape(-1, self.size)
+            block[block_rows[edited]] = cumulative_probabilities[edited] + block_rows[edited][:, numpy.newaxis]
+            step_sampler.blocks[block_number] = block.ravel()
+        return step_sampler
+
+
+class SparseStepSampler:
+    """Inverse-CDF sampler of next nodes, for many rows of a sparse network at once
+
+    Each row's defined Links come first in its cumulative distribution, then
+    its undefined Links, which share one implicit mass and are picked by rank
+    among the destinations missing from the row, in O(log defined Links).
+
+    :param row_offsets: start of each row's Links, then the Link count
+    :param link_destinations: destination Node.index of each Link
+    :param link_probabilities: probability of each Link
+    :param undefined_probabilities: probability of each undefined Link in each row
+    :param int size: number of Nodes
+    """
+
+    def __init__(self, row_offsets, link_destinations, link_probabilities, undefined_probabilities, size):
+        self.size = size
+        self.row_offsets = row_offsets
+        self.link_destinations = link_destinations
+        self.undefined_probabilities = undefined_probabilities
+        link_counts = numpy.diff(row_offsets)
+        link_rows = numpy.repeat(numpy.arange(len(link_counts)), link_counts)
+        cumulative_probabilities = numpy.concatenate(([0], numpy.cumsum(link_probabilities)))
+        row_starts = cumulative_probabilities[row_offsets[:-1]]
+        self.offset_probabilities = cumulative_probabilities[1:] - row_starts[link_rows] + link_rows
+        self.defined_probabilities = cumulative_probabilities[row_offsets[1:]] - row_starts
+        self.undefined_counts = size - link_counts
+        # Destinations missing before each Link, offset by row so they stay sorted
+        link_columns = numpy.arange(len(link_destinations)) - row_offsets[link_rows]
+        self.offset_gaps = link_rows * size + link_destinations - link_columns
+
+    def sample(self, rows, draws):
+        """Return the next Node.index for each row, given uniform draws
+
+        :param rows: array of row numbers
+        :param draws: array of uniform draws on [0, 1)
+        :return: array of Node.index values
+        :rtype: numpy.ndarray
+        """
+        undefined = (draws >= self.defined_probabilities[rows]) & (self.undefined_counts[rows] > 0)
+        next_nodes = numpy.empty(len(rows), dtype=int)
+        defined_rows, defined_draws = rows[~undefined], draws[~undefined]
+        positions = numpy.searchsorted(self.offset_probabilities, defined_draws + defined_rows, side='right')
+        positions = numpy.clip(positions, self.row_offsets[defined_rows], self.row_offsets[defined_rows + 1] - 1)
+        next_nodes[~undefined] = self.link_destinations[positions]
+        undefined_rows, undefined_draws = rows[undefined], draws[undefined]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ranks = ((undefined_draws - self.defined_probabilities[undefined_rows]) /
+                     self.undefined_probabilities[undefined_rows])
+        ranks = numpy.clip(numpy.nan_to_num(ranks), 0, self.undefined_counts[undefined_rows] - 1).astype(int)
+        preceding = (numpy.searchsorted(self.offset_gaps, undefined_rows * self.size + ranks, side='right') -
+                     self.row_offsets[undefined_rows])
+        next_nodes[undefined] = ranks + preceding
+        return next_nodes
+
+
+class AliasTable:
+    """Walker/Vose alias table, for O(1) draws from a discrete distribution
+
+    :param probabilities: probability of drawing each index
+    :ivar list acceptances: probability of keeping each drawn column
+    :ivar list aliases: index drawn instead of each rejected column
+    """
+
+    def __init__(self, probabilities):
+        scaled_probabilities = [probability * len(probabilities) for probability in probabilities]
+        self.acceptances = [1.0] * len(probabilities)
+        self.aliases = list(range(len(probabilities)))
+        small = [i for i, probability in enumerate(scaled_probabilities) if probability < 1]
+        large = [i for i, probability in enumerate(scaled_probabilities) if probability >= 1]
+        while small and large:
+            small_index, large_index = small.pop(), large.pop()
+            self.acceptances[small_index] = scaled_probabilities[small_index]
+            self.aliases[small_index] = large_index
+            scaled_probabilities[large_index] -= 1 - scaled_probabilities[small_index]
+            if scaled_probabilities[large_index] < 1:
+                small.append(large_index)
+            else:
+                large.append(large_index)
+        # Leftovers are 1 up to rounding error, so they always keep their column
+
+    def draw(self):
+        """Return a random index, drawn with its probability
+
+        :return: drawn index
+        :rtype: int
+        """
+        column = random.randrange(len(self.acceptances))
+        if random.random() < self.acceptances[column]:
+            return column
+        return self.aliases[column]
+
+
+class SparseAliasTable(AliasTable):
+    """Alias table over the defined Links of a sparse row, plus their complement
+
+    The last column holds the mass of every undefined Link, which is then
+    split uniformly by rank among the destinations missing from the row.
+
+    :param link_probabilities: probability of each defined Link
+    :param float undefined_probability: probability of each undefined Link
+    :param destinations: sorted Node.index of each defined Link's destination
+    :param int size: number of Nodes
+    :ivar list destinations: Node.index of each defined Link's destination
+    :ivar list gaps: number of destinations missing before each defined Link
+    :ivar int undefined_count: number of undefined Links
+    """
+
+    def __init__(self, link_probabilities, undefined_probability, destinations, size):
+        self.destinations = destinations.tolist()
+        self.gaps = [destination - i for i, destination in enumerate(self.destinations)]
+        self.undefined_count = size - len(self.destinations)
+        probabilities = link_probabilities.tolist()
+        if self.undefined_count:
+            probabilities.append(undefined_probability * self.undefined_count)
+        AliasTable.__init__(self, probabilities)
+
+    def draw(self):
+        """Return a random Node.index, drawn with its probability
+
+        :return: drawn Node.index
+        :rtype: int
+        """
+        column = AliasTable.draw(self)
+        if column < len(self.destinations):
+            return self.destinations[column]
+        rank = random.randrange(self.undefined_count)
+        return rank + bisect_right(self.gaps, rank)
+
+
+def sample_sequences(step_sampler, sequence_length, preferences_batch, n):
+    """Return an array of n sequences of node ids picked in lockstep by a step sampler
+
+    Stream i uses preferences_batch[i % len(preferences_batch)], and the first
+    node of each stream is uniformly random.
+
+    :param step_sampler: StepSampler or SparseStepSampler of the network
+    :param int sequence_length: length of sequences to sample
+    :param preferences_batch: preference tuple, or sequence of preference tuples
+    :param int n: number of sequences to sample
+    :return: (n x sequence_length) array of Node.index values
+    :rtype: numpy.ndarray
+    """
+    size = step_sampler.size
+    preferences_batch = numpy.atleast_2d(numpy.asarray(preferences_batch, dtype=int))
+    stream_batch_rows = numpy.arange(n) % len(preferences_batch)
+    sequences = numpy.empty((n, sequence_length), dtype=int)
+    sequences[:, 0] = numpy.random.randint(size, size=n)
+    for sequence_step in range(1, sequence_length):
+        this_nodes = sequences[:, sequence_step - 1]
+        rows = preferences_batch[stream_batch_rows, this_nodes] * size + this_nodes
+        sequences[:, sequence_step] = step_sampler.sample(rows, numpy.random.random_sample(n))
+    return sequences
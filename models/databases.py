@@ -1,8 +1,16 @@
+from collections.abc import MutableMapping
+from instruments import INSTRUMENTS
 from itertools import product
+from math import gcd
+from statistics import NormalDist
+import json
+import numpy
+import os
 import random
 
 
-PRINT = False
+STORAGES = ('links', 'dense', 'sparse')
+SPARSE_CHUNK_ROWS = 4096
 
 
 class Network:
@@ -10,65 +18,359 @@ class Network:
 
     :param int size: number of Nodes
     :param float interactivity: number of user inputs possible at every Node
+    :param str storage: 'links' for Link objects, 'dense' for a utility tensor,
+                        'sparse' for compressed rows of defined Links
     :ivar int size: number of nodes
     :ivar float interactivity: number of user inputs possible at every Node
+    :ivar str storage: 'links' for Link objects, 'dense' for a utility tensor,
+                       'sparse' for compressed rows of defined Links
     :ivar list nodes: all Nodes
+    :ivar utilities: (interactivity x size x size) utility tensor, if dense
+    :ivar defined: (interactivity x size x size) defined Link mask, if dense
+    :ivar row_offsets: start of each row's Links, then the Link count, if sparse
+    :ivar link_destinations: destination Node.index of each Link, if sparse
+    :ivar link_utilities: utility of each Link, if sparse
+
+    Sparse rows are numbered response * size + source, and each row's Links are
+    sorted by destination, as in a CSR matrix.
+
+    Edits made through Links mark their source Node's response as edited (see
+    Node.touch), which is how derived tables such as the Curator's alias tables
+    stay current. Writers of the arrays themselves must call Node.touch.
     """
 
-    def __init__(self, size=10, interactivity=2):
+    def __init__(self, size=10, interactivity=2, storage='links'):
+        if storage not in STORAGES:
+            raise ValueError('storage must be one of ' + ', '.join(STORAGES))
         self.size = size
         self.interactivity = interactivity
+        self.storage = storage
         self.nodes = []
+        self.utilities = None
+        self.defined = None
+        self.row_offsets = None
+        self.link_destinations = None
+        self.link_utilities = None
         self.make_nodes()
 
     def make_nodes(self):
         """Make list of self.size Nodes
+
+        Dense and sparse networks also allocate empty Link arrays, which their
+        Nodes view through ``Node.links``.
         """
-        self.nodes = [Node(name='Node' + str(n + 1)) for n in range(self.size)]
+        self.nodes = [Node(name='Node' + str(n + 1), index=n) for n in range(self.size)]
+        if self.storage == 'dense':
+            shape = (self.interactivity, self.size, self.size)
+            self.utilities = numpy.zeros(shape)
+            self.defined = numpy.zeros(shape, dtype=bool)
+        elif self.storage == 'sparse':
+            self.row_offsets = numpy.zeros(self.interactivity * self.size + 1, dtype=numpy.int64)
+            self.link_destinations = numpy.zeros(0, dtype=numpy.int64)
+            self.link_utilities = numpy.zeros(0)
+        if self.storage != 'links':
+            for node in self.nodes:
+                node.links = NodeLinks(self, node)
 
     def make_all_links(self):
         """Make 1-utility Links for all pairs of different nodes in self.nodes
 
         Links are defined for a specific combination of source, destination, and
         response, where the response is the user input at the source Node.
+
+        Dense and sparse networks fill their arrays in one shot; prefer them
+        to Link objects for large networks.
         """
+        if self.storage == 'dense':
+            self.utilities.fill(1)
+            self.defined.fill(True)
+            self.touch_all()
+            return
+        if self.storage == 'sparse':
+            rows = self.interactivity * self.size
+            self.row_offsets = numpy.arange(rows + 1, dtype=numpy.int64) * self.size
+            self.link_destinations = numpy.tile(numpy.arange(self.size, dtype=numpy.int64), rows)
+            self.link_utilities = numpy.ones(rows * self.size)
+            self.touch_all()
+            return
         for source, destination in product(self.nodes, self.nodes):
-            for response in range(self.interactivity):
-                link = Link(source, destination, response, utility=1)
-                try:
-                    source.links[destination][response] = link
-                except KeyError:
-                    source.links[destination] = {response: link}
+            source.links[destination] = {response: Link(source, destination, response, utility=1)
+                                         for response in range(self.interactivity)}
 
-    def make_random_links(self, density=0.1, skew_power=1):
+    def make_random_links(self, density=0.1, skew_power=1, seed=None):
         """Make random-utility Links for ``density`` fraction of self.nodes
 
         Links are defined for a specific combination of source, destination, and
         response, where the response is the user input at the source Node.
 
+        Only the defined Links are drawn: gaps between them, in (response,
+        source, destination) order, are geometric. Draws are made in bulk from
+        a numpy.random.Generator of ``seed``, or from the global numpy.random
+        generator if there is no seed, so a seed gives the same network every
+        time, in every storage.
+
         :param float density: fraction of defined Links over all Links
         :param float skew_power: Link utility distribution power (u~x^SP on (0, 1))
+        :param seed: seed or numpy.random.Generator of the draws
         """
-        for source, destination in product(self.nodes, self.nodes):
+        random_source = numpy.random if seed is None else numpy.random.default_rng(seed)
+        link_count = self.interactivity * self.size * self.size
+        link_numbers = numpy.zeros(0, dtype=numpy.int64)
+        if density >= 1:
+            link_numbers = numpy.arange(link_count, dtype=numpy.int64)
+        elif density > 0:
+            last_number = -1
+            chunks = []
+            while last_number < link_count:
+                expected_count = int(density * (link_count - last_number)) + 100
+                chunk = last_number + numpy.cumsum(random_source.geometric(density, size=expected_count))
+                chunks.append(chunk)
+                last_number = chunk[-1]
+            link_numbers = numpy.concatenate(chunks)
+            link_numbers = link_numbers[link_numbers < link_count]
+        # Draw utility from x^skew_power on (0, 1)
+        link_utilities = random_source.random(len(link_numbers)) ** skew_power
+        rows, destinations = numpy.divmod(link_numbers, self.size)
+        if self.storage == 'sparse':
+            self.link_destinations = destinations
+            self.row_offsets = numpy.searchsorted(rows, numpy.arange(self.interactivity * self.size + 1))
+            self.link_utilities = link_utilities
+            self.touch_all()
+            return
+        if self.storage == 'dense':
+            self.defined = numpy.zeros(self.defined.shape, dtype=bool)
+            self.utilities = numpy.zeros(self.utilities.shape)
+            self.defined.flat[link_numbers] = True
+            self.utilities.flat[link_numbers] = link_utilities
+            self.touch_all()
+            return
+        responses, sources = numpy.divmod(rows, self.size)
+        nodes = self.nodes
+        for response, source_index, destination_index, utility in zip(responses.tolist(), sources.tolist(),
+                                                                      destinations.tolist(), link_utilities.tolist()):
+            source, destination = nodes[source_index], nodes[destination_index]
+            link = Link(source, destination, response, utility)
+            try:
+                source.links[destination][response] = link
+            except KeyError:
+                source.links[destination] = {response: link}
+
+    def touch_all(self):
+        """Mark the Links leaving every Node for every response as edited
+        """
+        for node in self.nodes:
             for response in range(self.interactivity):
-                # Skip some pairs, according to ``density``
-                if random.random() > density:
-                    continue
-                # Draw utility from x^skew_power on (0, 1)
-                utility = random.random() ** skew_power
-                link = Link(source, destination, response, utility)
-                try:
-                    source.links[destination][response] = link
-                except KeyError:
-                    source.links[destination] = {response: link}
+                node.touch(response)
 
     def get_all_preferences(self):
-        """Return a tuple of all possible tuples of input preferences.
+        """Return a lazy sequence of all possible tuples of input preferences.
+
+        :return: all input preferences, in ``product()`` order
+        :rtype: PreferenceSpace
+        """
+        return PreferenceSpace(self.size, self.interactivity)
+
+    def get_utility_tensor(self):
+        """Return the (interactivity x size x size) tensor of Link utilities
+
+        Entry [response, source, destination] is 0 for any undefined Link.
+
+        :return: tensor of Link utilities, indexed by Node.index
+        :rtype: numpy.ndarray
+        """
+        if self.storage == 'dense':
+            return self.utilities
+        utilities = numpy.zeros((self.interactivity, self.size, self.size))
+        if self.storage == 'sparse':
+            rows = numpy.repeat(numpy.arange(self.interactivity * self.size), numpy.diff(self.row_offsets))
+            utilities.reshape(-1, self.size)[rows, self.link_destinations] = self.link_utilities
+            return utilities
+        for source in self.nodes:
+            for destination, links in source.links.items():
+                for response, link in links.items():
+                    utilities[response, source.index, destination.index] = link.utility
+        return utilities
+
+    def get_link_utilities(self, source, response):
+        """Return the utilities of Links leaving source for the response
+
+        :param source: source Node
+        :param int response: user input at source Node
+        :return: utility of the Link to every Node, 0 if undefined
+        :rtype: numpy.ndarray
+        """
+        if self.storage == 'dense':
+            return self.utilities[response, source.index]
+        utilities = numpy.zeros(self.size)
+        if self.storage == 'sparse':
+            links = self.get_row_slice(response, source.index)
+            utilities[self.link_destinations[links]] = self.link_utilities[links]
+            return utilities
+        for destination, links in source.links.items():
+            if response in links:
+                utilities[destination.index] = links[response].utility
+        return utilities
+
+    def get_utility_matrix(self, preferences):
+        """Return the (size x size) matrix of Link utilities under preferences
+
+        Row i holds the utilities of Links leaving self.nodes[i] for the
+        response preferences[i], with 0 for any undefined Link.
+
+        :param tuple preferences: user input at each node in self.nodes
+        :return: matrix of Link utilities, indexed by Node.index
+        :rtype: numpy.ndarray
+        """
+        sources = numpy.arange(self.size)
+        if self.storage == 'sparse':
+            utilities = numpy.zeros((self.size, self.size))
+            for source, response in enumerate(preferences):
+                links = self.get_row_slice(response, source)
+                utilities[source, self.link_destinations[links]] = self.link_utilities[links]
+            return utilities
+        return self.get_utility_tensor()[numpy.asarray(preferences), sources, :]
+
+    def get_row_slice(self, response, source_index):
+        """Return the slice of a sparse network's Link arrays leaving a source
 
-        :return: tuple of all input preferences
+        :param int response: user input at the source Node
+        :param int source_index: Node.index of the source Node
+        :rtype: slice
+        """
+        row = response * self.size + source_index
+        return slice(int(self.row_offsets[row]), int(self.row_offsets[row + 1]))
+
+    def get_link_probabilities(self, probability_conversion, rows=None):
+        """Return step probabilities of a sparse network's defined Links
+
+        ``probability_conversion`` must normalize elementwise weights of the
+        utilities, as Curator.exponential_mechanism and Adversary.normalize do.
+        Each row is converted with its defined utilities padded by zeros, and
+        the padded probabilities are rescaled so that every undefined Link
+        gets a zero utility's weight, in O(defined Links) time.
+
+        :param probability_conversion: row-wise utilities to probabilities function
+        :param range rows: rows to convert, all rows if None
+        :return: probability of each Link in the rows, in link array order, and
+                 probability of each undefined Link in each row
         :rtype: tuple
         """
-        return tuple(sequence for sequence in product(range(self.interactivity), repeat=self.size))
+        rows = range(len(self.row_offsets) - 1) if rows is None else rows
+        link_probabilities = []
+        undefined_probabilities = []
+        for first_row in range(rows.start, rows.stop, SPARSE_CHUNK_ROWS):
+            offsets = self.row_offsets[first_row:min(first_row + SPARSE_CHUNK_ROWS, rows.stop) + 1]
+            link_counts = numpy.diff(offsets)
+            link_rows = numpy.repeat(numpy.arange(len(link_counts)), link_counts)
+            link_columns = numpy.arange(offsets[0], offsets[-1]) - numpy.repeat(offsets[:-1], link_counts)
+            padded_utilities = numpy.zeros((len(link_counts), link_counts.max(initial=0) + 1))
+            padded_utilities[link_rows, link_columns] = self.link_utilities[offsets[0]:offsets[-1]]
+            padded_probabilities = numpy.asarray(probability_conversion(padded_utilities), dtype=float)
+            # The last column is always padding, so it holds a zero utility's probability
+            zero_probabilities = padded_probabilities[:, -1]
+            defined_probabilities = padded_probabilities[link_rows, link_columns]
+            totals = (numpy.bincount(link_rows, weights=defined_probabilities, minlength=len(link_counts)) +
+                      (self.size - link_counts) * zero_probabilities)
+            link_probabilities.append(defined_probabilities / totals[link_rows])
+            undefined_probabilities.append(zero_probabilities / totals)
+        return (numpy.concatenate(link_probabilities or [numpy.zeros(0)]),
+                numpy.concatenate(undefined_probabilities or [numpy.zeros(0)]))
+
+    def get_link_utility(self, response, source_index, destination_index):
+        """Return the utility of a defined Link of an array-backed network
+
+        :param int response: user input at the source Node
+        :param int source_index: Node.index of the source Node
+        :param int destination_index: Node.index of the destination Node
+        :raises KeyError: if the Link is undefined
+        :rtype: float
+        """
+        if self.storage == 'dense':
+            if not self.defined[response, source_index, destination_index]:
+                raise KeyError(response)
+            return self.utilities[response, source_index, destination_index]
+        links = self.get_row_slice(response, source_index)
+        position = links.start + numpy.searchsorted(self.link_destinations[links], destination_index)
+        if position == links.stop or self.link_destinations[position] != destination_index:
+            raise KeyError(response)
+        return self.link_utilities[position]
+
+    def set_link_utility(self, response, source_index, destination_index, utility):
+        """Set the utility of a Link of an array-backed network, defining it if needed
+
+        :param int response: user input at the source Node
+        :param int source_index: Node.index of the source Node
+        :param int destination_index: Node.index of the destination Node
+        :param float utility: utility of use
+        """
+        if self.storage == 'dense':
+            self.defined[response, source_index, destination_index] = True
+            self.utilities[response, source_index, destination_index] = utility
+        else:
+            links = self.get_row_slice(response, source_index)
+            position = links.start + numpy.searchsorted(self.link_destinations[links], destination_index)
+            if position < links.stop and self.link_destinations[position] == destination_index:
+                self.link_utilities[position] = utility
+            else:
+                self.link_destinations = numpy.insert(self.link_destinations, position, destination_index)
+                self.link_utilities = numpy.insert(self.link_utilities, position, utility)
+                # New arrays, not in-place edits, so samplers built before keep consistent rows
+                row_offsets = self.row_offsets.copy()
+                row_offsets[response * self.size + source_index + 1:] += 1
+                self.row_offsets = row_offsets
+        self.nodes[source_index].touch(response)
+
+    def delete_link(self, response, source_index, destination_index):
+        """Undefine a Link of an array-backed network
+
+        :param int response: user input at the source Node
+        :param int source_index: Node.index of the source Node
+        :param int destination_index: Node.index of the destination Node
+        :raises KeyError: if the Link is undefined
+        """
+        self.get_link_utility(response, source_index, destination_index)
+        if self.storage == 'dense':
+            self.defined[response, source_index, destination_index] = False
+            self.utilities[response, source_index, destination_index] = 0
+        else:
+            links = self.get_row_slice(response, source_index)
+            position = links.start + numpy.searchsorted(self.link_destinations[links], destination_index)
+            self.link_destinations = numpy.delete(self.link_destinations, position)
+            self.link_utilities = numpy.delete(self.link_utilities, position)
+            row_offsets = self.row_offsets.copy()
+            row_offsets[response * self.size + source_index + 1:] -= 1
+            self.row_offsets = row_offsets
+        self.nodes[source_index].touch(response)
+
+    def get_link_responses(self, source_index, destination_index):
+        """Return the responses defining Links between two Nodes of an array-backed network
+
+        :param int source_index: Node.index of the source Node
+        :param int destination_index: Node.index of the destination Node
+        :rtype: list
+        """
+        if self.storage == 'dense':
+            return numpy.flatnonzero(self.defined[:, source_index, destination_index]).tolist()
+        responses = []
+        for response in range(self.interactivity):
+            try:
+                self.get_link_utility(response, source_index, destination_index)
+            except KeyError:
+                continue
+            responses.append(response)
+        return responses
+
+    def get_link_destinations(self, source_index):
+        """Return the Node.index of every Node linked from a source of an array-backed network
+
+        :param int source_index: Node.index of the source Node
+        :rtype: list
+        """
+        if self.storage == 'dense':
+            return numpy.flatnonzero(self.defined[:, source_index, :].any(axis=0)).tolist()
+        destinations = [self.link_destinations[self.get_row_slice(response, source_index)]
+                        for response in range(self.interactivity)]
+        return numpy.unique(numpy.concatenate(destinations)).tolist()
 
     def get_random_preferences(self):
         """Return a random tuple of user input preferences, one for each node
@@ -78,45 +380,406 @@ class Network:
         """
         return tuple(random.choice(range(self.interactivity)) for _ in self.nodes)
 
+    def get_transition_matrix(self, preferences, probability_conversion):
+        """Return the (size x size) matrix of step probabilities under preferences
+
+        Row i holds the probabilities of stepping from self.nodes[i] to every
+        Node, from one call of ``probability_conversion`` on the whole utility
+        matrix, which must convert each row (last axis) independently.
+
+        :param tuple preferences: user input at each node in self.nodes
+        :param probability_conversion: row-wise utilities to probabilities function
+        :return: matrix of step probabilities, indexed by Node.index
+        :rtype: numpy.ndarray
+        """
+        return numpy.asarray(probability_conversion(self.get_utility_matrix(preferences)))
+
+    def get_log_transition_matrix(self, preferences, log_probability_conversion):
+        """Return the (size x size) matrix of step log probabilities under preferences
+
+        :param tuple preferences: user input at each node in self.nodes
+        :param log_probability_conversion: row-wise utilities to log probabilities
+                                           function, such as Curator.log_exponential_mechanism
+        :return: matrix of step log probabilities, indexed by Node.index
+        :rtype: numpy.ndarray
+        """
+        return numpy.asarray(log_probability_conversion(self.get_utility_matrix(preferences)))
+
     def sequence_probabilities(self, preferences, sequence_length, probability_conversion):
-        """Return a list of probabilities for every possible sequence
+        """Return an array of probabilities for every possible sequence
 
-        :return: list of probabilities for every possible sequence
-        :rtype: list
+        Sequences are ordered as in ``product(self.nodes, repeat=sequence_length)``.
+        The transition matrix is computed once, and every step multiplies all
+        sequence prefixes by it through one broadcasted outer product.
+
+        :param tuple preferences: user input at each node in self.nodes
+        :param int sequence_length: length of sequences
+        :param probability_conversion: row-wise utilities to probabilities function
+        :return: array of probabilities for every possible sequence
+        :rtype: numpy.ndarray
         """
-        sequences = list(product(self.nodes, repeat=sequence_length))
-        sequence_probabilities = [1.0 / len(self.nodes)] * len(sequences)
-        progress_bar_prefix = 'Calculating every sequence probability'
-        progress_bar_progress = 0
-        progress_bar_size = 76 - len(progress_bar_prefix)
-        if PRINT:
-            print(progress_bar_prefix + ' |' + ' ' * progress_bar_size + '|', end='\r')
-        for sequence_index in range(len(sequences)):
-            if sequence_index / len(sequences) > progress_bar_progress / progress_bar_size:
-                progress_bar_progress += 1
-                if PRINT:
-                    print(progress_bar_prefix + ' |' +
-                          '-' * progress_bar_progress +
-                          ' ' * (progress_bar_size - progress_bar_progress) + '|', end='\r')
+        with INSTRUMENTS.timer('sequence_probabilities'):
+            transitions = self.get_transition_matrix(preferences, probability_conversion)
+            sequence_probabilities = numpy.full(self.size, 1.0 / self.size)
             for sequence_step in range(sequence_length - 1):
-                this_node = sequences[sequence_index][sequence_step]
-                next_node = sequences[sequence_index][sequence_step + 1]
-                preference = preferences[self.nodes.index(this_node)]
-                utilities = []
-                for other_node in self.nodes:
-                    try:
-                        utilities.append(this_node.links[other_node][preference].utility)
-                    except KeyError:
-                        utilities.append(0)
-                probabilities = probability_conversion(utilities)
-                step_probability = probabilities[self.nodes.index(next_node)]
-                sequence_probabilities[sequence_index] *= step_probability
-        if PRINT:
-            print('\r' + progress_bar_prefix + ' |' + '-' * progress_bar_size + '|')
-        assert sum(sequence_probabilities) < 1.0001
-        assert sum(sequence_probabilities) > 0.9999
+                # [prefix, last node, next node] flattens to lexicographic order
+                sequence_probabilities = (sequence_probabilities.reshape(-1, self.size, 1) *
+                                          transitions).reshape(-1)
+                INSTRUMENTS.progress('Calculating every sequence probability', sequence_step + 1, sequence_length - 1)
+        INSTRUMENTS.count('probability_evaluations', len(sequence_probabilities))
+        assert sequence_probabilities.sum() < 1.0001
+        assert sequence_probabilities.sum() > 0.9999
         return sequence_probabilities
 
+    def log_sequence_probabilities(self, preferences, sequence_length, log_probability_conversion):
+        """Return an array of log probabilities for every possible sequence
+
+        As self.sequence_probabilities, with the product of step probabilities
+        taken as a sum of step log probabilities, so long sequences cannot
+        underflow. The array has the log probability conversion's dtype.
+
+        :param tuple preferences: user input at each node in self.nodes
+        :param int sequence_length: length of sequences
+        :param log_probability_conversion: row-wise utilities to log probabilities function
+        :return: array of log probabilities for every possible sequence
+        :rtype: numpy.ndarray
+        """
+        with INSTRUMENTS.timer('log_sequence_probabilities'):
+            log_transitions = self.get_log_transition_matrix(preferences, log_probability_conversion)
+            log_sequence_probabilities = numpy.full(self.size, -numpy.log(self.size), dtype=log_transitions.dtype)
+            for sequence_step in range(sequence_length - 1):
+                log_sequence_probabilities = (log_sequence_probabilities.reshape(-1, self.size, 1) +
+                                              log_transitions).reshape(-1)
+        INSTRUMENTS.count('probability_evaluations', len(log_sequence_probabilities))
+        return log_sequence_probabilities
+
+    def iter_sequence_probabilities(self, preferences, sequence_length, probability_conversion,
+                                    block_size=2 ** 20):
+        """Yield blocks of probabilities for every possible sequence
+
+        Concatenated, the blocks equal self.sequence_probabilities, but only one
+        block of at most ``block_size`` probabilities (or self.size, if larger)
+        is held at a time. Each block shares one sequence prefix, and is that
+        prefix's probability times every suffix's probability.
+
+        :param tuple preferences: user input at each node in self.nodes
+        :param int sequence_length: length of sequences
+        :param probability_conversion: row-wise utilities to probabilities function
+        :param int block_size: maximum number of probabilities per block
+        :return: iterator of probability arrays, in lexicographic sequence order
+        """
+        transitions = self.get_transition_matrix(preferences, probability_conversion)
+        suffix_length = 1
+        while suffix_length < sequence_length and self.size ** (suffix_length + 1) <= block_size:
+            suffix_length += 1
+        for prefix in product(range(self.size), repeat=sequence_length - suffix_length):
+            if prefix:
+                block = 1.0 / self.size * transitions[prefix[-1]]
+                for this_node, next_node in zip(prefix, prefix[1:]):
+                    block = block * transitions[this_node, next_node]
+            else:
+                block = numpy.full(self.size, 1.0 / self.size)
+            for sequence_step in range(suffix_length - 1):
+                block = (block.reshape(-1, self.size, 1) * transitions).reshape(-1)
+            yield block
+
+    def top_sequences(self, preferences, sequence_length, k, probability_conversion):
+        """Return the k most probable sequences and their probabilities
+
+        This is an exact k-best Viterbi search: a sequence among the k best
+        has, at every step, a prefix among the k best prefixes ending at the
+        same Node, so only size * k prefixes are kept per step. Log
+        probabilities are used throughout, so long sequences cannot underflow.
+
+        :param tuple preferences: user input at each node in self.nodes
+        :param int sequence_length: length of sequences
+        :param int k: number of sequences to return
+        :param probability_conversion: row-wise utilities to probabilities function
+        :return: (k x sequence_length) array of Node.index values and array of
+                 their probabilities, most probable first
+        :rtype: tuple
+        """
+        with numpy.errstate(divide='ignore'):
+            log_transitions = numpy.log(self.get_transition_matrix(preferences, probability_conversion))
+        nodes = numpy.arange(self.size)
+        # scores[j, m] is the log probability of the m-th best prefix ending at node j
+        scores = numpy.full((self.size, 1), -numpy.log(self.size))
+        back_pointers = []
+        for sequence_step in range(sequence_length - 1):
+            # candidates[i * ranks + m, j] extends prefix (i, m) to node j
+            candidates = (scores[:, :, numpy.newaxis] + log_transitions[:, numpy.newaxis, :]).reshape(-1, self.size)
+            ranks = min(k, len(candidates))
+            best = numpy.argpartition(-candidates, ranks - 1, axis=0)[:ranks]
+            order = numpy.argsort(-candidates[best, nodes], axis=0, kind='stable')
+            best = numpy.take_along_axis(best, order, axis=0)
+            back_pointers.append(divmod(best.T, scores.shape[1]))
+            scores = candidates[best, nodes].T
+        flat_scores = scores.ravel()
+        best = numpy.argsort(-flat_scores, kind='stable')[:k]
+        last_nodes, last_ranks = divmod(best, scores.shape[1])
+        sequences = numpy.empty((len(best), sequence_length), dtype=int)
+        sequences[:, -1] = last_nodes
+        for sequence_step in range(sequence_length - 2, -1, -1):
+            previous_nodes, previous_ranks = back_pointers[sequence_step]
+            last_nodes, last_ranks = (previous_nodes[last_nodes, last_ranks],
+                                      previous_ranks[last_nodes, last_ranks])
+            sequences[:, sequence_step] = last_nodes
+        return sequences, numpy.exp(flat_scores[best])
+
+    def estimate_divergence(self, preferences, sequence_length, probability_conversion, approx_network,
+                            approx_probability_conversion, precision=1e-3, confidence=0.95, batch_size=2 ** 16,
+                            max_samples=2 ** 24, top_k=None, seed=None):
+        """Return Monte Carlo estimates comparing an approximate network's sequence distribution to this one's
+
+        Sequences are drawn from this network's chain in vectorized batches and
+        scored under both networks, which makes each draw an importance sample
+        of the divergences with this chain as proposal: the KL divergence is
+        the mean of log(p / q), and the total variation the mean of
+        max(0, 1 - q / p). Sampling stops once both confidence intervals are
+        within ``precision`` of their estimates, or after ``max_samples``, so
+        the cost depends on the precision, not on size ** sequence_length.
+
+        With ``top_k``, the overlap of both networks' k most probable
+        sequences is also found exactly (see self.top_sequences).
+
+        :param tuple preferences: user input at each node in self.nodes
+        :param int sequence_length: length of sequences
+        :param probability_conversion: row-wise utilities to probabilities function
+        :param Network approx_network: network approximating this one
+        :param approx_probability_conversion: approx_network's probability conversion
+        :param float precision: largest confidence interval half width to stop at
+        :param float confidence: confidence level of the intervals
+        :param int batch_size: number of sequences drawn at once
+        :param int max_samples: number of sequences to stop at regardless
+        :param int top_k: number of top sequences to compare, if any
+        :param seed: seed or numpy.random.Generator of the draws
+        :return: 'kl_divergence', 'total_variation' and their '_half_width's,
+                 'samples', and 'top_k_overlap' if asked
+        :rtype: dict
+        """
+        random_source = numpy.random if seed is None else numpy.random.default_rng(seed)
+        transitions = self.get_transition_matrix(preferences, probability_conversion)
+        approx_transitions = approx_network.get_transition_matrix(preferences, approx_probability_conversion)
+        with numpy.errstate(divide='ignore'):
+            log_ratios = numpy.log(transitions) - numpy.log(approx_transitions)
+        cumulative_probabilities = numpy.cumsum(transitions, axis=-1)
+        cumulative_probabilities[:, -1] = 1
+        offset_probabilities = (cumulative_probabilities + numpy.arange(self.size)[:, numpy.newaxis]).ravel()
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        # Running sums of each sample's divergence terms and their squares
+        sums = numpy.zeros(2)
+        square_sums = numpy.zeros(2)
+        samples = 0
+        while samples < max_samples:
+            count = min(batch_size, max_samples - samples)
+            nodes = (random_source.random(count) * self.size).astype(int)
+            sample_log_ratios = numpy.zeros(count)
+            for sequence_step in range(sequence_length - 1):
+                positions = numpy.searchsorted(offset_probabilities, random_source.random(count) + nodes, side='right')
+                next_nodes = numpy.minimum(positions - nodes * self.size, self.size - 1)
+                sample_log_ratios += log_ratios[nodes, next_nodes]
+                nodes = next_nodes
+            with numpy.errstate(over='ignore', invalid='ignore'):
+                terms = numpy.array([sample_log_ratios, numpy.maximum(0, 1 - numpy.exp(-sample_log_ratios))])
+                sums += terms.sum(axis=1)
+                square_sums += (terms ** 2).sum(axis=1)
+            samples += count
+            means = sums / samples
+            with numpy.errstate(invalid='ignore'):
+                half_widths = z * numpy.sqrt(numpy.maximum(square_sums / samples - means ** 2, 0) / samples)
+            if not numpy.isfinite(means[0]) or (half_widths <= precision).all():
+                break
+        estimates = {'kl_divergence': float(means[0]), 'kl_divergence_half_width': float(half_widths[0]),
+                     'total_variation': float(means[1]), 'total_variation_half_width': float(half_widths[1]),
+                     'samples': samples}
+        if top_k:
+            sequences = self.top_sequences(preferences, sequence_length, top_k, probability_conversion)[0]
+            approx_sequences = approx_network.top_sequences(preferences, sequence_length, top_k,
+                                                            approx_probability_conversion)[0]
+            shared = set(map(tuple, sequences.tolist())) & set(map(tuple, approx_sequences.tolist()))
+            estimates['top_k_overlap'] = len(shared) / len(sequences)
+        return estimates
+
+    def save(self, directory):
+        """Save this network to a directory of .npy arrays and a JSON header
+
+        Dense and links networks save their utility tensor and Link mask,
+        sparse networks save their CSR arrays.
+
+        :param str directory: directory to save to, created if needed
+        """
+        os.makedirs(directory, exist_ok=True)
+        header = {'size': self.size, 'interactivity': self.interactivity, 'storage': self.storage,
+                  'names': [node.name for node in self.nodes]}
+        with open(os.path.join(directory, 'network.json'), 'w') as header_file:
+            json.dump(header, header_file)
+        if self.storage == 'sparse':
+            arrays = {'row_offsets': self.row_offsets, 'link_destinations': self.link_destinations,
+                      'link_utilities': self.link_utilities}
+        elif self.storage == 'dense':
+            arrays = {'utilities': self.utilities, 'defined': self.defined}
+        else:
+            defined = numpy.zeros((self.interactivity, self.size, self.size), dtype=bool)
+            for source in self.nodes:
+                for destination, links in source.links.items():
+                    defined[list(links), source.index, destination.index] = True
+            arrays = {'utilities': self.get_utility_tensor(), 'defined': defined}
+        for name, array in arrays.items():
+            numpy.save(os.path.join(directory, name + '.npy'), array)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Return a network saved with Network.save
+
+        Dense and sparse arrays are memory-mapped, so loading takes no time,
+        and processes loading the same directory share its pages. With the
+        default read-only ``mmap_mode``, Link utilities cannot be edited; use
+        'c' for private copy-on-write edits or None to read arrays into memory.
+
+        :param str directory: directory saved to
+        :param str mmap_mode: numpy.load memory-map mode
+        :rtype: Network
+        """
+        with open(os.path.join(directory, 'network.json')) as header_file:
+            header = json.load(header_file)
+        network = cls(header['size'], header['interactivity'], storage=header['storage'])
+        for node, name in zip(network.nodes, header['names']):
+            node.name = name
+
+        def load_array(name):
+            return numpy.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+
+        if network.storage == 'sparse':
+            network.row_offsets = load_array('row_offsets')
+            network.link_destinations = load_array('link_destinations')
+            network.link_utilities = load_array('link_utilities')
+        elif network.storage == 'dense':
+            network.utilities = load_array('utilities')
+            network.defined = load_array('defined')
+        else:
+            utilities = load_array('utilities')
+            for response, source, destination in zip(*numpy.nonzero(load_array('defined'))):
+                source_node, destination_node = network.nodes[source], network.nodes[destination]
+                link = Link(source_node, destination_node, int(response), float(utilities[response, source, destination]))
+                source_node.links.setdefault(destination_node, {})[int(response)] = link
+        network.touch_all()
+        return network
+
+    def save_sequence_probabilities(self, path, preferences, sequence_length, probability_conversion,
+                                    block_size=2 ** 20):
+        """Compute every sequence probability straight into a .npy file
+
+        Blocks from self.iter_sequence_probabilities are written to a memory
+        map, so the table never has to fit in memory. Load it with
+        load_probabilities.
+
+        :param str path: path of the .npy file
+        :param tuple preferences: user input at each node in self.nodes
+        :param int sequence_length: length of sequences
+        :param probability_conversion: row-wise utilities to probabilities function
+        :param int block_size: maximum number of probabilities per block
+        """
+        table = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.float64,
+                                             shape=(self.size ** sequence_length,))
+        start = 0
+        for block in self.iter_sequence_probabilities(preferences, sequence_length, probability_conversion,
+                                                      block_size):
+            table[start:start + len(block)] = block
+            start += len(block)
+        table.flush()
+        del table
+
+
+class SequenceProbabilityCache:
+    """Sequence probabilities of a Network, recomputed only where Links changed
+
+    The cache remembers the version (see Node.touch) of every row of Links
+    used under its preferences. On update, each edited row's transitions are
+    reconverted, and only the blocks of sequences passing through that row's
+    Node before their last step are recomputed, instead of all size ** length.
+
+    :param network: Network whose sequence probabilities to cache
+    :param tuple preferences: user input at each node in network.nodes
+    :param int sequence_length: length of sequences
+    :param probability_conversion: row-wise utilities to probabilities function
+    :ivar network: Network whose sequence probabilities are cached
+    :ivar tuple preferences: user input at each node in network.nodes
+    :ivar int sequence_length: length of sequences
+    :ivar probability_conversion: row-wise utilities to probabilities function
+    :ivar numpy.ndarray transitions: current transition matrix
+    :ivar numpy.ndarray probabilities: current probability of every sequence
+    :ivar numpy.ndarray versions: version of each Node's row when last converted
+    :ivar int recomputed_rows: number of rows reconverted by updates so far
+    """
+
+    def __init__(self, network, preferences, sequence_length, probability_conversion):
+        self.network = network
+        self.preferences = preferences
+        self.sequence_length = sequence_length
+        self.probability_conversion = probability_conversion
+        self.recomputed_rows = 0
+        self.versions = self.get_versions()
+        self.transitions = numpy.array(network.get_transition_matrix(preferences, probability_conversion),
+                                       dtype=float)
+        self.probabilities = network.sequence_probabilities(preferences, sequence_length, probability_conversion)
+
+    def get_versions(self):
+        """Return the current version of each Node's row under the preferences
+
+        :rtype: numpy.ndarray
+        """
+        return numpy.array([node.versions.get(self.preferences[node.index], 0) for node in self.network.nodes])
+
+    def get_block(self, position, node_index):
+        """Return probabilities of the sequences with a given Node at a given step
+
+        :param int position: step of the sequence
+        :param int node_index: Node.index at that step
+        :return: probabilities in lexicographic order of the other steps
+        :rtype: numpy.ndarray
+        """
+        allowed_nodes = [numpy.arange(self.network.size)] * self.sequence_length
+        allowed_nodes[position] = numpy.array([node_index])
+        block = numpy.full(len(allowed_nodes[0]), 1.0 / self.network.size)
+        for this_nodes, next_nodes in zip(allowed_nodes, allowed_nodes[1:]):
+            block = (block.reshape(-1, len(this_nodes), 1) *
+                     self.transitions[numpy.ix_(this_nodes, next_nodes)]).reshape(-1)
+        return block
+
+    def update(self):
+        """Bring the cached probabilities up to date with the network
+
+        Falls back to a full recomputation when so many rows changed that the
+        blocks would cover more sequences than there are.
+
+        :return: current probability of every sequence
+        :rtype: numpy.ndarray
+        """
+        versions = self.get_versions()
+        dirty_nodes = numpy.flatnonzero(versions != self.versions)
+        self.versions = versions
+        if not len(dirty_nodes):
+            return self.probabilities
+        self.recomputed_rows += len(dirty_nodes)
+        if len(dirty_nodes) * (self.sequence_length - 1) >= self.network.size:
+            self.transitions = numpy.array(self.network.get_transition_matrix(self.preferences,
+                                                                              self.probability_conversion),
+                                           dtype=float)
+            self.probabilities = self.network.sequence_probabilities(self.preferences, self.sequence_length,
+                                                                     self.probability_conversion)
+            return self.probabilities
+        utilities = numpy.array([self.network.get_link_utilities(self.network.nodes[node_index],
+                                                                 self.preferences[node_index])
+                                 for node_index in dirty_nodes])
+        self.transitions[dirty_nodes] = self.probability_conversion(utilities)
+        probabilities = self.probabilities.reshape((self.network.size,) * self.sequence_length)
+        for node_index in dirty_nodes:
+            for position in range(self.sequence_length - 1):
+                index = tuple(node_index if axis == position else slice(None)
+                              for axis in range(self.sequence_length))
+                probabilities[index] = self.get_block(position, node_index).reshape(probabilities[index].shape)
+        return self.probabilities
+
 
 class Link:
     """Link in a Network, connecting two source and destination Nodes
@@ -137,6 +800,15 @@ class Link:
         self.preference = preference
         self.utility = utility
 
+    @property
+    def utility(self):
+        return self._utility
+
+    @utility.setter
+    def utility(self, utility):
+        self._utility = utility
+        self.source.touch(self.preference)
+
     def __repr__(self):
         return ('Link ' + str(self.source) + ' to ' + str(self.destination) +
                 ' \t if %d \t utility %.3g' % (self.preference, self.utility))
@@ -146,20 +818,263 @@ class Link:
                 ' \t if %d \t utility %.3g' % (self.preference, self.utility))
 
 
+class ArrayLink(Link):
+    """Link viewing one Link of a dense or sparse Network's arrays
+
+    :param network: Network holding the utility
+    :param source: source Node
+    :param destination: destination Node
+    :param int preference: user input at source Node
+    :ivar network: Network holding the utility
+    """
+
+    def __init__(self, network, source, destination, preference):
+        self.network = network
+        self.source = source
+        self.destination = destination
+        self.preference = preference
+
+    @property
+    def utility(self):
+        return self.network.get_link_utility(self.preference, self.source.index, self.destination.index)
+
+    @utility.setter
+    def utility(self, utility):
+        self.network.set_link_utility(self.preference, self.source.index, self.destination.index, utility)
+
+
+class NodeLinks(MutableMapping):
+    """Neighbor Nodes keying to response Links, viewed from a dense or sparse Network
+
+    :param network: Network holding the Links
+    :param source: source Node of the Links
+    """
+
+    def __init__(self, network, source):
+        self.network = network
+        self.source = source
+
+    def __getitem__(self, destination):
+        if not self.network.get_link_responses(self.source.index, destination.index):
+            raise KeyError(destination)
+        return ResponseLinks(self.network, self.source, destination)
+
+    def __setitem__(self, destination, links):
+        response_links = ResponseLinks(self.network, self.source, destination)
+        response_links.clear()
+        response_links.update(links)
+
+    def __delitem__(self, destination):
+        self[destination].clear()
+
+    def __iter__(self):
+        destinations = self.network.get_link_destinations(self.source.index)
+        return (self.network.nodes[index] for index in destinations)
+
+    def __len__(self):
+        return len(self.network.get_link_destinations(self.source.index))
+
+
+class ResponseLinks(MutableMapping):
+    """Responses keying to Links between two Nodes, viewed from a dense or sparse Network
+
+    :param network: Network holding the Links
+    :param source: source Node of the Links
+    :param destination: destination Node of the Links
+    """
+
+    def __init__(self, network, source, destination):
+        self.network = network
+        self.source = source
+        self.destination = destination
+
+    def __getitem__(self, response):
+        self.network.get_link_utility(response, self.source.index, self.destination.index)
+        return ArrayLink(self.network, self.source, self.destination, response)
+
+    def __setitem__(self, response, link):
+        self.network.set_link_utility(response, self.source.index, self.destination.index, link.utility)
+
+    def __delitem__(self, response):
+        self.network.delete_link(response, self.source.index, self.destination.index)
+
+    def __iter__(self):
+        return iter(self.network.get_link_responses(self.source.index, self.destination.index))
+
+    def __len__(self):
+        return len(self.network.get_link_responses(self.source.index, self.destination.index))
+
+
 class Node:
     """Node in a Network, connected to other nodes by weighted Links
 
     :param str name: node ID or descriptor
+    :param int index: position of this Node in its Network's nodes
     :ivar str name: node ID or descriptor
+    :ivar int index: position of this Node in its Network's nodes
     :ivar dict links: neighbor Nodes keying to Links
+    :ivar dict versions: responses keying to their number of Link edits
     """
 
-    def __init__(self, name):
+    def __init__(self, name, index=None):
         self.name = name
+        self.index = index
         self.links = {}
+        self.versions = {}
+
+    def touch(self, response):
+        """Mark the Links leaving this Node for the response as edited
+
+        :param int response: user input at this Node
+        """
+        self.versions[response] = self.versions.get(response, 0) + 1
 
     def __repr__(self):
         return self.name
 
     def __str__(self):
-        return self.name    
+        return self.name
+
+
+class PreferenceSpace:
+    """Lazy sequence of preference tuples, in ``product()`` order
+
+    Preference tuple number n is the base-interactivity digits of n, so items
+    are decoded in O(size) rather than stored, and memory stays constant.
+    Slicing returns another PreferenceSpace.
+
+    :param int size: number of Nodes
+    :param int interactivity: number of user inputs possible at every Node
+    :param range numbers: preference tuple numbers, all of them if None
+    :ivar int size: number of Nodes
+    :ivar int interactivity: number of user inputs possible at every Node
+    :ivar range numbers: preference tuple numbers
+    :ivar int cardinality: number of preference tuples, even beyond sys.maxsize
+    """
+
+    def __init__(self, size, interactivity, numbers=None):
+        self.size = size
+        self.interactivity = interactivity
+        self.numbers = range(interactivity ** size) if numbers is None else numbers
+        if self.numbers.step > 0:
+            span = self.numbers.stop - self.numbers.start + self.numbers.step - 1
+        else:
+            span = self.numbers.stop - self.numbers.start + self.numbers.step + 1
+        self.cardinality = max(0, span // self.numbers.step)
+
+    def __len__(self):
+        return self.cardinality
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return PreferenceSpace(self.size, self.interactivity, self.numbers[key])
+        return self.decode(self.numbers[key])
+
+    def __iter__(self):
+        return (self.decode(number) for number in self.numbers)
+
+    def __repr__(self):
+        return 'PreferenceSpace(%d, %d, %r)' % (self.size, self.interactivity, self.numbers)
+
+    def decode(self, number):
+        """Return preference tuple number ``number``
+
+        :param int number: preference tuple number
+        :return: tuple of user input preferences
+        :rtype: tuple
+        """
+        preferences = [0] * self.size
+        for i in range(self.size - 1, -1, -1):
+            number, preferences[i] = divmod(number, self.interactivity)
+        return tuple(preferences)
+
+    def decode_run(self, number, step, count):
+        """Return preference tuples number, number + step, ..., number + (count - 1) * step
+
+        For numbers too big for int64, only the first number is decoded in
+        full. The low digits of the run are int64 arithmetic, and their carries
+        into the high digits take a few distinct values, each decoded once.
+
+        :param int number: first preference tuple number
+        :param int step: difference between consecutive numbers
+        :param int count: number of preference tuples
+        :return: (count x size) array of user input preferences
+        :rtype: numpy.ndarray
+        """
+        low_size = 1
+        while low_size < self.size and self.interactivity ** (low_size + 1) <= 2 ** 40:
+            low_size += 1
+        place_value = self.interactivity ** low_size
+        if count * abs(step) >= 2 ** 62 - place_value:
+            return numpy.array([self.decode(number + i * step) for i in range(count)], dtype=int).reshape(count, -1)
+        high, low = divmod(number, place_value)
+        carries, lows = numpy.divmod(low + step * numpy.arange(count, dtype=numpy.int64), place_value)
+        preferences = numpy.empty((count, self.size), dtype=int)
+        low_place_values = self.interactivity ** numpy.arange(low_size - 1, -1, -1, dtype=numpy.int64)
+        preferences[:, self.size - low_size:] = lows[:, numpy.newaxis] // low_place_values % self.interactivity
+        distinct_carries, carry_indices = numpy.unique(carries, return_inverse=True)
+        high_preferences = numpy.array([self.decode(high + carry)[low_size:] for carry in distinct_carries.tolist()],
+                                       dtype=int).reshape(len(distinct_carries), self.size - low_size)
+        preferences[:, :self.size - low_size] = high_preferences[carry_indices.ravel()]
+        return preferences
+
+    def strided(self, stride, start=0):
+        """Return every ``stride``-th preference tuple, from ``start``
+
+        :param int stride: step between preference tuples
+        :param int start: index of the first preference tuple
+        :rtype: PreferenceSpace
+        """
+        return self[start::stride]
+
+    def shuffled(self, seed=None):
+        """Iterate over every preference tuple once, in a seeded random order
+
+        The order is the affine permutation i -> (a * i + b) mod cardinality,
+        with random a coprime to the cardinality, so nothing is materialized.
+
+        :param seed: seed for the random permutation
+        :return: iterator of preference tuples
+        """
+        generator = random.Random(seed)
+        cardinality = self.cardinality
+        multiplier = 1
+        if cardinality > 2:
+            multiplier = generator.randrange(1, cardinality)
+            while gcd(multiplier, cardinality) != 1:
+                multiplier = generator.randrange(1, cardinality)
+        offset = generator.randrange(cardinality) if cardinality else 0
+        return (self[(multiplier * i + offset) % cardinality] for i in range(cardinality))
+
+    def get_batch(self, start, count):
+        """Return an array of ``count`` preference tuples, cycling from ``start``
+
+        :param int start: index of the first preference tuple
+        :param int count: number of preference tuples
+        :return: (count x size) array of user input preferences
+        :rtype: numpy.ndarray
+        """
+        if self.interactivity ** self.size >= 2 ** 62:
+            batch = numpy.empty((count, self.size), dtype=int)
+            filled = 0
+            while filled < count:
+                position = (start + filled) % self.cardinality
+                run_count = min(count - filled, self.cardinality - position)
+                batch[filled:filled + run_count] = self.decode_run(self.numbers[position], self.numbers.step,
+                                                                   run_count)
+                filled += run_count
+            return batch
+        positions = (start + numpy.arange(count, dtype=numpy.int64)) % self.cardinality
+        numbers = self.numbers.start + positions * self.numbers.step
+        place_values = self.interactivity ** numpy.arange(self.size - 1, -1, -1, dtype=numpy.int64)
+        return numbers[:, numpy.newaxis] // place_values % self.interactivity
+
+
+def load_probabilities(path, mmap_mode='r'):
+    """Return a probability table saved as a .npy file, memory-mapped
+
+    :param str path: path of the .npy file
+    :param str mmap_mode: numpy.load memory-map mode
+    :rtype: numpy.ndarray
+    """
+    return numpy.load(path, mmap_mode=mmap_mode)
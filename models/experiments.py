@@ -0,0 +1,314 @@
+from adversaries import Adversary
+from caches import cached, set_cache, to_builtin
+from curators import Curator
+from databases import Network, SequenceProbabilityCache
+from metrics import kl_divergence, top_sequences_errors
+import csv
+import hashlib
+import json
+import multiprocessing
+import numpy
+import random
+
+
+def seed_cell(seed, cell):
+    """Seed the global random and numpy.random generators for one sweep cell
+
+    Seeds derive from the sweep seed and a hash of the cell's parameters
+    alone, so a cell draws the same numbers whichever worker runs it, however
+    many workers there are, and wherever it sits in the sweep. Identical
+    cells draw identical numbers; repeats need a parameter telling them apart.
+
+    :param int seed: seed of the whole sweep
+    :param dict cell: JSON-serializable parameters of the cell
+    """
+    cell_text = json.dumps(cell, sort_keys=True, default=to_builtin)
+    cell_hash = int.from_bytes(hashlib.sha256(cell_text.encode()).digest()[:16], 'big')
+    random_seed, numpy_seed = numpy.random.SeedSequence([seed, cell_hash]).generate_state(2)
+    random.seed(int(random_seed))
+    numpy.random.seed(int(numpy_seed))
+
+
+def run_cell(arguments):
+    """Run one seeded sweep cell
+
+    The global random and numpy.random states are restored afterwards, so
+    cells run in the caller's process leave its generators as they were.
+
+    :param tuple arguments: cell function, sweep seed, cell number, cell and
+                            the ResultCache for the cell function's own results
+    :return: cell number and the cell function's list of result rows
+    :rtype: tuple
+    """
+    cell_function, seed, cell_number, cell, cache = arguments
+    states = random.getstate(), numpy.random.get_state()
+    set_cache(cache)
+    seed_cell(seed, cell)
+    try:
+        return cell_number, cell_function(cell)
+    finally:
+        set_cache(None)
+        random.setstate(states[0])
+        numpy.random.set_state(states[1])
+
+
+def get_cell_config(cell_function, seed, cell):
+    """Return the configuration identifying a sweep cell's result rows in a ResultCache
+
+    The cell's position in the sweep is left out, so adding or removing
+    other cells keeps its rows cached.
+
+    :rtype: dict
+    """
+    return {'kind': 'sweep_cell', 'function': cell_function.__module__ + '.' + cell_function.__name__,
+            'seed': seed, 'cell': cell}
+
+
+def run_sweep(cell_function, cells, seed=0, processes=None, cache=None):
+    """Yield every cell's result rows, as cells finish
+
+    Cells run across a process pool, or in this process if ``processes`` is 1.
+    The cell function must be importable from a module (picklable), take a
+    cell dict and return a list of row dicts.
+
+    With a ResultCache, cells whose rows are cached for the same function,
+    seed, parameters and code are not rerun, wherever they sit in the sweep, and cell functions
+    may cache their own intermediate results through caches.cached.
+
+    :param cell_function: function of one cell returning its result rows
+    :param list cells: parameter dicts, one per cell
+    :param int seed: seed of the whole sweep
+    :param int processes: number of worker processes, all cores if None
+    :param ResultCache cache: cache of results, if any
+    :return: iterator of (cell number, result rows)
+    """
+    arguments = []
+    for cell_number, cell in enumerate(cells):
+        if cache is not None:
+            try:
+                rows = cache.load(cache.get_key(get_cell_config(cell_function, seed, cell)))
+                cache.hits += 1
+                yield cell_number, rows
+                continue
+            except KeyError:
+                cache.misses += 1
+        arguments.append((cell_function, seed, cell_number, cell, cache))
+    pool = None
+    if processes == 1 or not arguments:
+        results = map(run_cell, arguments)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(run_cell, arguments)
+    try:
+        for cell_number, rows in results:
+            if cache is not None:
+                cache.store(cache.get_key(get_cell_config(cell_function, seed, cells[cell_number])),
+                            rows)
+            yield cell_number, rows
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def write_sweep(cell_function, cells, path, seed=0, processes=None, cache=None):
+    """Run a sweep, writing every result row to a CSV table as its cell finishes
+
+    Each row is prefixed by its cell number and the cell's scalar parameters.
+    Every row of a sweep must have the same columns.
+
+    :param cell_function: function of one cell returning its result rows
+    :param list cells: parameter dicts, one per cell
+    :param str path: path of the CSV table
+    :param int seed: seed of the whole sweep
+    :param int processes: number of worker processes, all cores if None
+    :param ResultCache cache: cache of results, if any
+    :return: every row, in cell order
+    :rtype: list
+    """
+    rows = []
+    with open(path, 'w', newline='') as table_file:
+        writer = None
+        for cell_number, cell_rows in run_sweep(cell_function, cells, seed, processes, cache):
+            parameters = {key: value for key, value in cells[cell_number].items()
+                          if isinstance(value, (int, float, str))}
+            for cell_row in cell_rows:
+                row = dict(cell=cell_number, **parameters)
+                row.update(cell_row)
+                if writer is None:
+                    writer = csv.DictWriter(table_file, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+                rows.append(row)
+            table_file.flush()
+    return sorted(rows, key=lambda row: row['cell'])
+
+
+def read_sweep(path):
+    """Return the rows of a sweep's CSV table, with numbers parsed
+
+    :param str path: path of the CSV table
+    :return: every row, in table order
+    :rtype: list
+    """
+    rows = []
+    with open(path, newline='') as table_file:
+        for row in csv.DictReader(table_file):
+            for key, value in row.items():
+                try:
+                    row[key] = int(value)
+                except ValueError:
+                    try:
+                        row[key] = float(value)
+                    except ValueError:
+                        pass
+            rows.append(row)
+    return rows
+
+
+def network_cell(cell):
+    """Return the sorted Link utilities and sequence probabilities of a random network
+
+    :param dict cell: epsilon, density, size, interactivity, sequence_length,
+                      skew_power, and optionally storage
+    :return: rows of kind 'link' or 'sequence', with rank and value
+    :rtype: list
+    """
+    curator = Curator(epsilon=cell['epsilon'])
+    curator.network = Network(size=cell['size'], interactivity=cell['interactivity'],
+                              storage=cell.get('storage', 'links'))
+    curator.network.make_random_links(density=cell['density'], skew_power=cell['skew_power'])
+    preferences = curator.network.get_random_preferences()
+    sequence_length = cell['sequence_length']
+    sequence_probabilities = sorted([probability for probability in
+                                     curator.network.sequence_probabilities(preferences,
+                                                                            sequence_length,
+                                                                            curator.exponential_mechanism)
+                                     if probability > 10 ** (- sequence_length)], reverse=True)
+    link_utilities = sorted([link.utility
+                             for node in curator.network.nodes
+                             for links in node.links.values()
+                             for link in links.values()], reverse=True)
+    return ([{'kind': 'link', 'rank': rank, 'value': float(utility)}
+             for rank, utility in enumerate(link_utilities)] +
+            [{'kind': 'sequence', 'rank': rank, 'value': float(probability)}
+             for rank, probability in enumerate(sequence_probabilities)])
+
+
+def attack(cell, adversary, query_count):
+    """Update an adversary by a block of queries, pirated or expected as the cell asks
+
+    :param dict cell: adversary_cell parameters
+    :param Adversary adversary: adversary to update
+    :param int query_count: number of queries
+    """
+    if cell.get('expected'):
+        adversary.expect(cell['sequence_length'], number_of_queries=query_count)
+    else:
+        adversary.pirate(cell['sequence_length'], number_of_queries=query_count, block_size=cell.get('block_size'))
+
+
+def adversary_cell(cell):
+    """Return the reconstruction errors of an adversary after each block of queries
+
+    With a ``network_seed``, the curator network and preferences are drawn
+    from that seed, so cells can share one network and differ in eta, and the
+    network, preferences and curator probability tables are cached (see
+    caches.cached).
+
+    :param dict cell: size, interactivity, sequence_length, eta, query_counts,
+                      cutoff_fractions, preference_count, and optionally
+                      network_seed, storage, block_size, expected, which
+                      applies expected Link counts instead of pirating, and
+                      precision, which estimates errors (see
+                      estimate_adversary_cell) instead of enumerating sequences
+    :return: rows of cumulative queries, preference number, KL divergence and
+             top sequences error at each cutoff fraction
+    :rtype: list
+    """
+    curator = Curator()
+    sequence_length = cell['sequence_length']
+
+    def make_network():
+        network = Network(cell['size'], cell['interactivity'], storage=cell.get('storage', 'links'))
+        network.make_random_links()
+        return network
+
+    def make_preferences():
+        return [curator.network.get_random_preferences() for _ in range(cell['preference_count'])]
+
+    def get_probability_table(preference):
+        def make_probability_table():
+            return curator.network.sequence_probabilities(preference, sequence_length, curator.exponential_mechanism)
+        if 'network_seed' not in cell:
+            return make_probability_table()
+        return cached(dict(network_config, kind='sequence_probabilities', preference=preference,
+                           sequence_length=sequence_length, epsilon=curator.epsilon), make_probability_table)
+
+    if 'network_seed' in cell:
+        network_config = {'size': cell['size'], 'interactivity': cell['interactivity'],
+                          'storage': cell.get('storage', 'links'), 'network_seed': cell['network_seed']}
+        states = random.getstate(), numpy.random.get_state()
+        random.seed(cell['network_seed'])
+        numpy.random.seed(cell['network_seed'])
+        curator.network = cached(dict(network_config, kind='network'), make_network)
+        preferences = tuple(tuple(preference) for preference in
+                            cached(dict(network_config, kind='preferences', count=cell['preference_count']),
+                                   make_preferences))
+        random.setstate(states[0])
+        numpy.random.set_state(states[1])
+    else:
+        curator.network = make_network()
+        preferences = tuple(make_preferences())
+    adversary = Adversary(curator, eta=cell['eta'])
+    if 'precision' in cell:
+        return estimate_adversary_cell(cell, curator, adversary, preferences)
+    curator_probability_tables = [get_probability_table(preference) for preference in preferences]
+    adversary_caches = [SequenceProbabilityCache(adversary.network, preference, sequence_length,
+                                                 Adversary.normalize)
+                        for preference in preferences]
+    rows = []
+    queries = 0
+    for query_count in cell['query_counts']:
+        attack(cell, adversary, int(query_count))
+        queries += int(query_count)
+        for preference_number in range(len(preferences)):
+            # Only rows edited by this block of queries are recomputed
+            adversary_probabilities = adversary_caches[preference_number].update()
+            curator_probabilities = curator_probability_tables[preference_number]
+            row = {'queries': queries, 'preference': preference_number,
+                   'kl_divergence': kl_divergence(curator_probabilities, adversary_probabilities)}
+            errors = top_sequences_errors(curator_probabilities, adversary_probabilities, cell['cutoff_fractions'])
+            for cutoff_fraction, error in zip(cell['cutoff_fractions'], errors):
+                row['error_%g' % cutoff_fraction] = float(error)
+            rows.append(row)
+    return rows
+
+
+def estimate_adversary_cell(cell, curator, adversary, preferences):
+    """Return Monte Carlo estimates of an adversary's errors after each block of queries
+
+    Sequences are sampled (see Network.estimate_divergence) rather than
+    enumerated, so sequences may be long.
+
+    :param dict cell: adversary_cell parameters with precision, and optionally top_k
+    :param Curator curator: curator of the target network
+    :param Adversary adversary: adversary of the curator
+    :param tuple preferences: preference tuples to evaluate under
+    :return: rows of cumulative queries, preference number, estimated KL
+             divergence and total variation with their confidence interval half
+             widths, samples drawn, and top k overlap if asked
+    :rtype: list
+    """
+    sequence_length = cell['sequence_length']
+    rows = []
+    queries = 0
+    for query_count in cell['query_counts']:
+        attack(cell, adversary, int(query_count))
+        queries += int(query_count)
+        for preference_number, preference in enumerate(preferences):
+            row = {'queries': queries, 'preference': preference_number}
+            row.update(curator.network.estimate_divergence(preference, sequence_length, curator.exponential_mechanism,
+                                                           adversary.network, Adversary.normalize,
+                                                           precision=cell['precision'], top_k=cell.get('top_k')))
+            rows.append(row)
+    return rows
@@ -0,0 +1,155 @@
+from contextlib import contextmanager, nullcontext
+import json
+import time
+
+
+NULL_TIMER = nullcontext()
+
+
+class Instruments:
+    """Counters, timers and progress callbacks shared by the models
+
+    Instruments start disabled. While disabled, self.count and self.progress
+    return at once and self.timer returns a shared no-op context, so hot paths
+    pay one attribute check. Hot loops should test self.enabled before
+    computing anything only needed for instrumentation.
+
+    :ivar bool enabled: whether measurements are recorded
+    :ivar dict counters: counter names keying to counts
+    :ivar dict timers: timer names keying to [total seconds, calls]
+    :ivar list progress_callbacks: functions of (task, done, total)
+    :ivar list sinks: functions of a metrics dict, called by self.export
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.timers = {}
+        self.progress_callbacks = []
+        self.sinks = []
+
+    def enable(self):
+        """Start recording measurements
+        """
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording measurements, keeping those recorded
+        """
+        self.enabled = False
+
+    def reset(self):
+        """Forget every count and time
+        """
+        self.counters = {}
+        self.timers = {}
+
+    def count(self, name, amount=1):
+        """Add an amount to a counter
+
+        :param str name: counter name
+        :param int amount: amount to add
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timer(self, name):
+        """Return a context that adds its wall time to a timer
+
+        :param str name: timer name
+        :return: context manager
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return self.time(name)
+
+    @contextmanager
+    def time(self, name):
+        """Return a context that adds its wall time to a timer, even while disabled
+
+        :param str name: timer name
+        :return: context manager
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            totals = self.timers.setdefault(name, [0.0, 0])
+            totals[0] += time.perf_counter() - start
+            totals[1] += 1
+
+    def progress(self, task, done, total):
+        """Report a task's progress to every progress callback
+
+        :param str task: task description
+        :param done: amount of the task done
+        :param total: amount of the whole task, 0 for a message
+        """
+        if self.enabled:
+            for callback in self.progress_callbacks:
+                callback(task, done, total)
+
+    def get_metrics(self):
+        """Return every count and time
+
+        :return: 'counters' keying to counts, 'timers' keying to seconds and calls
+        :rtype: dict
+        """
+        return {'counters': dict(self.counters),
+                'timers': {name: {'seconds': seconds, 'calls': calls}
+                           for name, (seconds, calls) in self.timers.items()}}
+
+    def export(self):
+        """Send every count and time to every sink
+
+        :return: the exported metrics
+        :rtype: dict
+        """
+        metrics = self.get_metrics()
+        for sink in self.sinks:
+            sink(metrics)
+        return metrics
+
+
+class ProgressBar:
+    """Progress callback drawing a carriage-return progress bar for each task
+
+    The bar is redrawn only when it grows, and finished with a new line. A
+    task with a total of 0 is printed as a message.
+
+    :param int width: characters in a whole line
+    """
+
+    def __init__(self, width=80):
+        self.width = width
+        self.task = None
+        self.progress = -1
+
+    def __call__(self, task, done, total):
+        if not total:
+            print(task)
+            return
+        bar_size = max(1, self.width - 4 - len(task))
+        bar_progress = bar_size * done // total
+        if task == self.task and bar_progress == self.progress:
+            return
+        self.task, self.progress = task, bar_progress
+        print(task + ' |' + '-' * bar_progress + ' ' * (bar_size - bar_progress) + '|',
+              end='\n' if done >= total else '\r')
+
+
+class JSONLinesSink:
+    """Metrics sink appending each export to a file as one line of JSON
+
+    :param str path: path of the file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, metrics):
+        with open(self.path, 'a') as sink_file:
+            sink_file.write(json.dumps(dict(metrics, time=time.time())) + '\n')
+
+
+INSTRUMENTS = Instruments()
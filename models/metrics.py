@@ -0,0 +1,126 @@
+import numpy
+
+
+CHUNK_SIZE = 2 ** 22
+
+
+def top_ranks(probabilities, k):
+    """Return the indices of the k largest probabilities, largest first
+
+    Only the k largest are sorted, after an O(n) argpartition.
+
+    :param probabilities: array of probabilities
+    :param int k: number of indices to return
+    :rtype: numpy.ndarray
+    """
+    probabilities = numpy.asarray(probabilities)
+    k = min(k, len(probabilities))
+    if k == 0:
+        return numpy.zeros(0, dtype=int)
+    top = numpy.argpartition(-probabilities, k - 1)[:k]
+    return top[numpy.argsort(-probabilities[top], kind='stable')]
+
+
+def top_k_overlaps(curator_probabilities, adversary_probabilities, ks):
+    """Return the fraction of the curator's top k sequences in the adversary's top k, for every k
+
+    A sequence is in both top k exactly when the larger of its two ranks is
+    below k, so every k is evaluated from one pass over the largest k.
+
+    :param curator_probabilities: curator's probability of every sequence
+    :param adversary_probabilities: adversary's probability of every sequence
+    :param ks: numbers of top sequences
+    :return: overlap fraction for each k
+    :rtype: numpy.ndarray
+    """
+    ks = numpy.asarray(ks, dtype=int)
+    largest_k = int(ks.max(initial=0))
+    curator_top = top_ranks(curator_probabilities, largest_k)
+    adversary_top = top_ranks(adversary_probabilities, largest_k)
+    adversary_ranks = numpy.full(len(curator_top), largest_k)
+    shared, curator_positions, adversary_positions = numpy.intersect1d(curator_top, adversary_top,
+                                                                       assume_unique=True, return_indices=True)
+    adversary_ranks[curator_positions] = adversary_positions
+    larger_ranks = numpy.sort(numpy.maximum(numpy.arange(len(curator_top)), adversary_ranks))
+    counts = numpy.searchsorted(larger_ranks, ks, side='left')
+    return counts / numpy.maximum(ks, 1)
+
+
+def top_sequences_errors(curator_probabilities, adversary_probabilities, cutoff_fractions):
+    """Return the fraction of the curator's top sequences missing from the adversary's, per cutoff
+
+    :param curator_probabilities: curator's probability of every sequence
+    :param adversary_probabilities: adversary's probability of every sequence
+    :param cutoff_fractions: fractions of sequences counted as top sequences
+    :return: top sequences error for each cutoff fraction
+    :rtype: numpy.ndarray
+    """
+    ks = [max(1, int(cutoff_fraction * len(curator_probabilities))) for cutoff_fraction in cutoff_fractions]
+    return 1 - top_k_overlaps(curator_probabilities, adversary_probabilities, ks)
+
+
+def kl_divergence(distribution, approx_distribution):
+    """Return the KL divergence of an approximate distribution from a distribution
+
+    Each term is weighted by its own probability, and terms of probability
+    0 contribute nothing. Terms are summed in chunks to bound memory.
+
+    :param distribution: original probability distribution
+    :param approx_distribution: approximate of the original distribution
+    :rtype: float
+    """
+    divergence = 0.0
+    for start in range(0, len(distribution), CHUNK_SIZE):
+        probabilities = numpy.asarray(distribution[start:start + CHUNK_SIZE], dtype=float)
+        approx_probabilities = numpy.asarray(approx_distribution[start:start + CHUNK_SIZE], dtype=float)
+        defined = probabilities > 0
+        with numpy.errstate(divide='ignore'):
+            divergence += numpy.sum(probabilities[defined] *
+                                    numpy.log(probabilities[defined] / approx_probabilities[defined]))
+    return float(divergence)
+
+
+def total_variation(distribution, approx_distribution):
+    """Return the total variation distance between two distributions
+
+    :param distribution: original probability distribution
+    :param approx_distribution: approximate of the original distribution
+    :rtype: float
+    """
+    distance = 0.0
+    for start in range(0, len(distribution), CHUNK_SIZE):
+        probabilities = numpy.asarray(distribution[start:start + CHUNK_SIZE], dtype=float)
+        approx_probabilities = numpy.asarray(approx_distribution[start:start + CHUNK_SIZE], dtype=float)
+        distance += numpy.abs(probabilities - approx_probabilities).sum()
+    return float(distance / 2)
+
+
+def average_ranks(values):
+    """Return the rank of each value, counting from 0, with ties given their average rank
+
+    :param values: array of values
+    :rtype: numpy.ndarray
+    """
+    _, inverse, counts = numpy.unique(numpy.asarray(values), return_inverse=True, return_counts=True)
+    midranks = numpy.cumsum(counts) - (counts + 1) / 2
+    return midranks[inverse.ravel()]
+
+
+def rank_correlation(distribution, approx_distribution):
+    """Return the Spearman rank correlation between two distributions
+
+    Ties are given their average rank, so a uniform distribution correlates
+    with nothing; the correlation is nan if either distribution is constant.
+
+    :param distribution: original probability distribution
+    :param approx_distribution: approximate of the original distribution
+    :rtype: float
+    """
+    ranks = average_ranks(distribution)
+    approx_ranks = average_ranks(approx_distribution)
+    ranks -= ranks.mean()
+    approx_ranks -= approx_ranks.mean()
+    variance = numpy.dot(ranks, ranks) * numpy.dot(approx_ranks, approx_ranks)
+    if variance == 0:
+        return float('nan')
+    return float(numpy.dot(ranks, approx_ranks) / numpy.sqrt(variance))
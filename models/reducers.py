@@ -0,0 +1,161 @@
+import heapq
+import math
+import numpy
+
+
+class SumReducer:
+    """Streaming sum of probability blocks
+
+    :ivar float total: sum of every probability so far
+    """
+
+    def __init__(self):
+        self.total = 0.0
+
+    def update(self, block, approx_block=None):
+        """Add a block of probabilities
+
+        :param block: array of probabilities
+        :param approx_block: unused
+        """
+        self.total = math.fsum((self.total, float(numpy.sum(block))))
+
+    def result(self):
+        """Return the sum of every probability so far
+
+        :rtype: float
+        """
+        return self.total
+
+    def check(self, tolerance=1e-4):
+        """Assert that the probabilities so far sum to 1, within tolerance
+
+        :param float tolerance: largest allowed distance from 1
+        """
+        assert abs(self.total - 1) < tolerance
+
+
+class TopKReducer:
+    """Streaming k largest probabilities, kept in a min-heap
+
+    :param int k: number of probabilities to keep
+    :ivar int k: number of probabilities to keep
+    :ivar list heap: (probability, index) of the k largest probabilities so far
+    :ivar int offset: index of the next block's first probability
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self.offset = 0
+
+    def update(self, block, approx_block=None):
+        """Add a block of probabilities
+
+        Only the block's own k largest probabilities are offered to the heap.
+
+        :param block: array of probabilities
+        :param approx_block: unused
+        """
+        block = numpy.asarray(block)
+        candidates = numpy.arange(len(block))
+        if len(block) > self.k:
+            candidates = numpy.argpartition(block, len(block) - self.k)[-self.k:]
+        for index in candidates.tolist():
+            item = (float(block[index]), self.offset + index)
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, item)
+            elif item[0] > self.heap[0][0]:
+                heapq.heapreplace(self.heap, item)
+        self.offset += len(block)
+
+    def result(self):
+        """Return the indices and values of the k largest probabilities so far
+
+        :return: array of sequence indices and array of their probabilities,
+                 most probable first
+        :rtype: tuple
+        """
+        items = sorted(self.heap, key=lambda item: (-item[0], item[1]))
+        return (numpy.array([index for _, index in items], dtype=int),
+                numpy.array([probability for probability, _ in items]))
+
+
+class HistogramReducer:
+    """Streaming histogram of probabilities over fixed bin edges
+
+    :param bins: increasing bin edges, 10^-20 to 1 in 20 log bins if None
+    :ivar numpy.ndarray bins: increasing bin edges
+    :ivar numpy.ndarray counts: number of probabilities in each bin so far
+    """
+
+    def __init__(self, bins=None):
+        self.bins = numpy.logspace(-20, 0, num=21) if bins is None else numpy.asarray(bins)
+        self.counts = numpy.zeros(len(self.bins) - 1, dtype=int)
+
+    def update(self, block, approx_block=None):
+        """Add a block of probabilities
+
+        :param block: array of probabilities
+        :param approx_block: unused
+        """
+        self.counts += numpy.histogram(block, bins=self.bins)[0]
+
+    def result(self):
+        """Return the number of probabilities in each bin so far
+
+        :rtype: numpy.ndarray
+        """
+        return self.counts
+
+
+class KLDivergenceReducer:
+    """Streaming KL divergence of an approximate distribution from another
+
+    Terms where the original probability is 0 contribute nothing.
+
+    :ivar float divergence: sum of p * log(p / q) so far
+    """
+
+    def __init__(self):
+        self.divergence = 0.0
+
+    def update(self, block, approx_block=None):
+        """Add a block of probabilities and the matching approximate block
+
+        :param block: array of original probabilities
+        :param approx_block: array of approximate probabilities
+        """
+        block = numpy.asarray(block)
+        approx_block = numpy.asarray(approx_block)
+        defined = block > 0
+        with numpy.errstate(divide='ignore'):
+            terms = block[defined] * numpy.log(block[defined] / approx_block[defined])
+        self.divergence = math.fsum((self.divergence, float(numpy.sum(terms))))
+
+    def result(self):
+        """Return the KL divergence so far
+
+        :rtype: float
+        """
+        return self.divergence
+
+
+def reduce_blocks(reducers, blocks, approx_blocks=None):
+    """Feed every block to every reducer in one pass, and return their results
+
+    :param list reducers: reducers to update
+    :param blocks: iterable of probability blocks
+    :param approx_blocks: iterable of matching approximate blocks, if needed
+    :return: result of each reducer
+    :rtype: list
+    """
+    if approx_blocks is None:
+        for block in blocks:
+            for reducer in reducers:
+                reducer.update(block)
+    else:
+        for block, approx_block in zip(blocks, approx_blocks):
+            for reducer in reducers:
+                reducer.update(block, approx_block)
+    return [reducer.result() for reducer in reducers]
@@ -0,0 +1,155 @@
+from curators import StepSampler, sample_sequences
+from contextlib import contextmanager
+import numpy
+import threading
+
+
+class NetworkSnapshot:
+    """Immutable sampling tables of a Curator's network at one version
+
+    Readers may sample from a snapshot from any thread without locks: its
+    arrays are read-only and never change once published.
+
+    :ivar int version: number of the snapshot, counting from 0
+    :ivar StepSampler step_sampler: sampler of next nodes, with read-only tables
+    :ivar list node_versions: copy of each Node's versions when snapshotted
+    :ivar list names: name of each Node
+    :ivar int size: number of Nodes
+    """
+
+    def __init__(self, version, step_sampler, node_versions, names):
+        for block in step_sampler.blocks:
+            block.flags.writeable = False
+        self.version = version
+        self.step_sampler = step_sampler
+        self.node_versions = node_versions
+        self.names = names
+        self.size = step_sampler.size
+
+    def sample(self, rows, draws):
+        """Return the next Node.index for each row, given uniform draws
+
+        :param rows: array of row numbers, response * size + source
+        :param draws: array of uniform draws on [0, 1)
+        :rtype: numpy.ndarray
+        """
+        return self.step_sampler.sample(rows, draws)
+
+    def query(self, sequence_length, preferences):
+        """Return a list of node names picked with the exponential mechanism, as Curator.query
+
+        :param int sequence_length: length of sequence to query
+        :param tuple preferences: user input at each node in the network
+        :return: list of node names
+        :rtype: list
+        """
+        return [self.names[index] for index in self.query_many(sequence_length, preferences, 1)[0].tolist()]
+
+    def query_many(self, sequence_length, preferences_batch, n):
+        """Return an array of n sequences of node ids, as Curator.query_many
+
+        :param int sequence_length: length of sequences to query
+        :param preferences_batch: preference tuple, or sequence of preference tuples
+        :param int n: number of sequences to query
+        :return: (n x sequence_length) array of Node.index values
+        :rtype: numpy.ndarray
+        """
+        return sample_sequences(self.step_sampler, sequence_length, preferences_batch, n)
+
+
+class NetworkSnapshots:
+    """Versioned, copy-on-write snapshots of a Curator's network
+
+    Writers edit the live network inside ``with self.editing():`` and then
+    call self.publish. Publishing compares every Node's versions (see
+    Node.touch) with the current snapshot's, recomputes the sampling rows of
+    only the edited (source, response) pairs into copies of the blocks
+    holding them, shares every other block with the current snapshot (see
+    StepSampler.replace_rows), and swaps the new snapshot in with one
+    attribute assignment.
+    Readers take self.current once and keep sampling from it lock-free, so a
+    stream in flight reads one version throughout. Only snapshots are safe to
+    query while the network is edited: Curator.query and Curator.query_many
+    read the live network.
+
+    Rows are held densely, whatever the network's storage. Changes the Node
+    versions do not record, such as of the Curator's epsilon, need
+    self.rebuild.
+
+    :param curator: curator of the network to snapshot
+    :ivar curator: curator of the network to snapshot
+    :ivar NetworkSnapshot current: latest published snapshot
+    :ivar int rebuilt_rows: number of sampling rows recomputed by publishing
+    """
+
+    def __init__(self, curator):
+        self.curator = curator
+        self.lock = threading.Lock()
+        self.rebuilt_rows = 0
+        self.current = None
+        self.rebuild()
+
+    def get_node_versions(self):
+        """Return a copy of each Node's versions
+
+        :rtype: list
+        """
+        return [dict(node.versions) for node in self.curator.network.nodes]
+
+    def get_names(self):
+        """Return the name of each Node
+
+        :rtype: list
+        """
+        return [node.name for node in self.curator.network.nodes]
+
+    @contextmanager
+    def editing(self):
+        """Return a context in which the live network may be edited
+
+        Writers are serialized with each other and with publishing; readers
+        are never blocked.
+        """
+        with self.lock:
+            yield
+
+    def rebuild(self):
+        """Publish a snapshot with every sampling row recomputed
+
+        :rtype: NetworkSnapshot
+        """
+        with self.lock:
+            version = 0 if self.current is None else self.current.version + 1
+            self.current = NetworkSnapshot(version, StepSampler(self.curator.get_cumulative_probabilities()),
+                                           self.get_node_versions(), self.get_names())
+            return self.current
+
+    def get_edited_rows(self):
+        """Return the row numbers of (source, response) pairs edited since the current snapshot
+
+        :rtype: numpy.ndarray
+        """
+        size = self.curator.network.size
+        rows = []
+        for node, snapshot_versions in zip(self.curator.network.nodes, self.current.node_versions):
+            for response, version in node.versions.items():
+                if snapshot_versions.get(response, 0) != version:
+                    rows.append(response * size + node.index)
+        return numpy.array(sorted(rows), dtype=int)
+
+    def publish(self):
+        """Publish a snapshot of the live network, rebuilding only edited rows
+
+        :return: the new snapshot, or the current one if nothing was edited
+        :rtype: NetworkSnapshot
+        """
+        with self.lock:
+            rows = self.get_edited_rows()
+            if not len(rows):
+                return self.current
+            step_sampler = self.current.step_sampler.replace_rows(
+                rows, self.curator.get_row_cumulative_probabilities(rows))
+            self.rebuilt_rows += len(rows)
+            self.current = NetworkSnapshot(self.current.version + 1, step_sampler, self.get_node_versions(),
+                                           self.current.names)
+            return self.current
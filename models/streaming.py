@@ -0,0 +1,219 @@
+from curators import Curator
+from databases import Network
+import argparse
+import asyncio
+import numpy
+import sys
+import time
+
+
+class StreamServer:
+    """Asyncio front end serving a Curator's sequences one node at a time
+
+    Sessions request their next node with self.next_node. Requests made in one
+    event-loop tick are served together in the next, by one batched call of
+    the Curator's step sampler, so each tick costs one searchsorted however
+    many sessions are waiting.
+
+    Each session samples from the step sampler current when it started, to its
+    end. Without snapshots, the step sampler is built from the network when
+    the server is created; call self.refresh after editing Link utilities.
+    With NetworkSnapshots, new sessions start on the latest published
+    snapshot, and sessions in flight keep reading theirs.
+
+    :param Curator curator: curator of the network to stream from
+    :param snapshots: NetworkSnapshots of the curator's network, if any
+    :ivar Curator curator: curator of the network to stream from
+    :ivar snapshots: NetworkSnapshots of the curator's network, if any
+    :ivar list pending: (Session, Future) requests waiting for the next tick
+    :ivar int batches: number of batched sampling calls made
+    :ivar int served: number of nodes served
+    """
+
+    def __init__(self, curator, snapshots=None):
+        self.curator = curator
+        self.snapshots = snapshots
+        self.pending = []
+        self.batches = 0
+        self.served = 0
+        self.refresh()
+
+    def refresh(self):
+        """Rebuild the step sampler and node names from the curator's network
+        """
+        self.size = self.curator.network.size
+        self.names = [node.name for node in self.curator.network.nodes]
+        self.step_sampler = None if self.snapshots is not None else self.curator.get_step_sampler()
+
+    def get_step_sampler(self):
+        """Return the step sampler new sessions start on
+
+        :rtype: StepSampler or SparseStepSampler
+        """
+        if self.snapshots is not None:
+            return self.snapshots.current.step_sampler
+        return self.step_sampler
+
+    def open_session(self, preferences):
+        """Return a new session streaming under preferences
+
+        :param tuple preferences: user input at each node in the network
+        :rtype: Session
+        """
+        return Session(self, preferences)
+
+    def next_node(self, session):
+        """Return a future of the session's next Node.index
+
+        :param Session session: session requesting a node
+        :rtype: asyncio.Future
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.pending:
+            loop.call_soon(self.serve_pending)
+        self.pending.append((session, future))
+        return future
+
+    def serve_pending(self):
+        """Sample the next node of every pending session at once
+        """
+        pending, self.pending = self.pending, []
+        size = self.size
+        rows = numpy.array([-1 if session.node is None else session.preferences[session.node] * size + session.node
+                            for session, future in pending], dtype=int)
+        starting = rows < 0
+        next_nodes = numpy.empty(len(rows), dtype=int)
+        # As in Curator.query, the first node of a session is uniformly random
+        next_nodes[starting] = numpy.random.randint(size, size=int(starting.sum()))
+        if starting.any():
+            step_sampler = self.get_step_sampler()
+            for position in numpy.flatnonzero(starting).tolist():
+                pending[position][0].step_sampler = step_sampler
+        # Sessions are grouped by step sampler, of which there is usually one
+        positions_by_sampler = {}
+        for position in numpy.flatnonzero(~starting).tolist():
+            step_sampler = pending[position][0].step_sampler
+            positions_by_sampler.setdefault(id(step_sampler), (step_sampler, []))[1].append(position)
+        for step_sampler, positions in positions_by_sampler.values():
+            next_nodes[positions] = step_sampler.sample(rows[positions], numpy.random.random_sample(len(positions)))
+        for (session, future), next_node in zip(pending, next_nodes.tolist()):
+            if not future.cancelled():
+                future.set_result(next_node)
+        self.batches += 1
+        self.served += len(pending)
+
+
+class Session:
+    """One consumer's stream of nodes from a StreamServer
+
+    :param StreamServer server: server sampling the nodes
+    :param tuple preferences: user input at each node in the network
+    :ivar tuple preferences: user input at each node in the network
+    :ivar int node: Node.index of the last node streamed, None before the first
+    :ivar step_sampler: sampler pinned at the first node, None before it
+    """
+
+    def __init__(self, server, preferences):
+        self.server = server
+        self.preferences = tuple(preferences)
+        self.node = None
+        self.step_sampler = None
+
+    def set_preferences(self, preferences):
+        """Change the preferences used for every following step
+
+        :param tuple preferences: user input at each node in the network
+        """
+        self.preferences = tuple(preferences)
+
+    async def stream(self, sequence_length=None):
+        """Yield node names one at a time, as they are requested
+
+        New preferences can be sent into the generator (``asend``), taking
+        effect from the next node on.
+
+        :param int sequence_length: number of nodes to yield, unlimited if None
+        :return: async generator of node names
+        """
+        sequence_step = 0
+        while sequence_length is None or sequence_step < sequence_length:
+            self.node = await self.server.next_node(self)
+            preferences = yield self.server.names[self.node]
+            if preferences is not None:
+                self.set_preferences(preferences)
+            sequence_step += 1
+
+
+async def consume(session, sequence_length, latencies, preference_change_probability=0.0):
+    """Pull a session's nodes one at a time, recording each request's latency
+
+    :param Session session: session to stream from
+    :param int sequence_length: number of nodes to pull
+    :param list latencies: list to append latencies, in seconds, to
+    :param float preference_change_probability: chance of new preferences after each node
+    """
+    stream = session.stream(sequence_length)
+    interactivity = session.server.curator.network.interactivity
+    preferences = None
+    for _ in range(sequence_length):
+        start = time.perf_counter()
+        if preferences is None:
+            await stream.__anext__()
+        else:
+            await stream.asend(preferences)
+        latencies.append(time.perf_counter() - start)
+        preferences = None
+        if preference_change_probability and numpy.random.random_sample() < preference_change_probability:
+            preferences = numpy.random.randint(interactivity, size=session.server.size).tolist()
+    await stream.aclose()
+
+
+async def generate_load(server, sessions, sequence_length, preference_change_probability=0.0):
+    """Stream from many simultaneous sessions, returning throughput and latencies
+
+    :param StreamServer server: server to load
+    :param int sessions: number of simultaneous sessions
+    :param int sequence_length: number of nodes each session pulls
+    :param float preference_change_probability: chance of new preferences after each node
+    :return: nodes, seconds, nodes per second, batches, and p50 and p99 latencies in seconds
+    :rtype: dict
+    """
+    network = server.curator.network
+    preferences_batch = numpy.random.randint(network.interactivity, size=(sessions, network.size)).tolist()
+    latencies = []
+    batches = server.batches
+    start = time.perf_counter()
+    await asyncio.gather(*[consume(server.open_session(preferences), sequence_length, latencies,
+                                   preference_change_probability)
+                           for preferences in preferences_batch])
+    seconds = time.perf_counter() - start
+    p50, p99 = numpy.percentile(latencies, [50, 99])
+    return dict(nodes=len(latencies), seconds=seconds, nodes_per_second=len(latencies) / seconds,
+                batches=server.batches - batches, p50_latency=float(p50), p99_latency=float(p99))
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Load test the streaming front end in-process')
+    parser.add_argument('--sessions', type=int, default=50000, help='simultaneous sessions')
+    parser.add_argument('--length', type=int, default=20, help='nodes pulled per session')
+    parser.add_argument('--size', type=int, default=100, help='number of nodes')
+    parser.add_argument('--interactivity', type=int, default=2, help='number of responses')
+    parser.add_argument('--density', type=float, default=0.1, help='link density')
+    parser.add_argument('--storage', default='dense', help='network storage')
+    parser.add_argument('--change', type=float, default=0.01, help='preference change probability per node')
+    arguments = parser.parse_args(arguments)
+
+    curator = Curator()
+    curator.network = Network(arguments.size, arguments.interactivity, storage=arguments.storage)
+    curator.network.make_random_links(density=arguments.density)
+    result = asyncio.run(generate_load(StreamServer(curator), arguments.sessions, arguments.length,
+                                       arguments.change))
+    print('%d nodes in %.3f s: %.4g nodes/s over %d batches, p50 latency %.3g ms, p99 latency %.3g ms' %
+          (result['nodes'], result['seconds'], result['nodes_per_second'], result['batches'],
+           1000 * result['p50_latency'], 1000 * result['p99_latency']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
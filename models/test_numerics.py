@@ -0,0 +1,153 @@
+from curators import Curator, StepSampler
+from databases import Network, PreferenceSpace
+from metrics import average_ranks, rank_correlation
+from snapshots import NetworkSnapshots
+import numpy as np
+
+
+DRAWS_PER_ROW = 20000
+
+
+def get_sampled_probabilities(step_sampler, row_count, size):
+    """Return the probability a step sampler gives each destination of each row
+
+    Every row is sampled at DRAWS_PER_ROW evenly spaced draws, so the result
+    is exact to within 1 / DRAWS_PER_ROW of the sampler's distribution.
+
+    :param step_sampler: StepSampler or SparseStepSampler
+    :param int row_count: number of rows, interactivity * size
+    :param int size: number of Nodes
+    :return: (row_count x size) sampled probabilities
+    :rtype: numpy.ndarray
+    """
+    rows = np.repeat(np.arange(row_count), DRAWS_PER_ROW)
+    draws = np.tile((np.arange(DRAWS_PER_ROW) + 0.5) / DRAWS_PER_ROW, row_count)
+    next_nodes = step_sampler.sample(rows, draws)
+    return np.bincount(rows * size + next_nodes, minlength=row_count * size).reshape(row_count, size) / DRAWS_PER_ROW
+
+
+def get_probabilities(curator):
+    """Return the exponential mechanism probabilities of every row of a curator's network
+
+    :rtype: numpy.ndarray
+    """
+    network = curator.network
+    return curator.exponential_mechanism(network.get_utility_tensor()).reshape(-1, network.size)
+
+
+def make_curator(storage, size=6, interactivity=2, density=0.3, seed=0):
+    """Return a curator of a seeded random network
+
+    :param str storage: storage of the network
+    :rtype: Curator
+    """
+    curator = Curator(epsilon=3)
+    curator.network = Network(size, interactivity, storage=storage)
+    curator.network.make_random_links(density, seed=seed)
+    return curator
+
+
+def test_step_samplers():
+    for storage in ('links', 'dense', 'sparse'):
+        curator = make_curator(storage)
+        network = curator.network
+        sampled = get_sampled_probabilities(curator.get_step_sampler(), network.interactivity * network.size,
+                                            network.size)
+        assert np.allclose(sampled, get_probabilities(curator), atol=2 / DRAWS_PER_ROW), storage
+
+
+def test_step_samplers_survive_edits():
+    for storage in ('dense', 'sparse'):
+        curator = make_curator(storage)
+        network = curator.network
+        row_count = network.interactivity * network.size
+        step_sampler = curator.get_step_sampler()
+        probabilities = get_probabilities(curator)
+        destination = next(index for index in range(network.size) if not network.get_link_responses(0, index))
+        network.set_link_utility(0, 0, destination, 1.0)
+        assert np.allclose(get_sampled_probabilities(step_sampler, row_count, network.size), probabilities,
+                           atol=2 / DRAWS_PER_ROW), storage
+        edited_sampler = curator.get_step_sampler()
+        edited_probabilities = get_probabilities(curator)
+        assert np.allclose(get_sampled_probabilities(edited_sampler, row_count, network.size),
+                           edited_probabilities, atol=2 / DRAWS_PER_ROW), storage
+        network.delete_link(0, 0, destination)
+        assert np.allclose(get_sampled_probabilities(edited_sampler, row_count, network.size),
+                           edited_probabilities, atol=2 / DRAWS_PER_ROW), storage
+        assert np.allclose(get_sampled_probabilities(curator.get_step_sampler(), row_count, network.size),
+                           probabilities, atol=2 / DRAWS_PER_ROW), storage
+
+
+def test_step_sampler_blocks():
+    curator = make_curator('dense', size=7, interactivity=3)
+    cumulative_probabilities = curator.get_cumulative_probabilities()
+    step_sampler = StepSampler(cumulative_probabilities)
+    blocked_sampler = StepSampler(cumulative_probabilities, block_rows=4)
+    assert len(step_sampler.blocks) == 1 and len(blocked_sampler.blocks) == 6
+    generator = np.random.RandomState(0)
+    rows, draws = generator.randint(21, size=10000), generator.random_sample(10000)
+    assert (step_sampler.sample(rows, draws) == blocked_sampler.sample(rows, draws)).all()
+    replaced_rows = [1, 2, 13]
+    new_probabilities = cumulative_probabilities.reshape(21, 7)[[20, 0, 5]]
+    replaced_sampler = blocked_sampler.replace_rows(replaced_rows, new_probabilities)
+    expected = cumulative_probabilities.reshape(21, 7).copy()
+    expected[replaced_rows] = new_probabilities
+    assert (replaced_sampler.sample(rows, draws) == StepSampler(expected).sample(rows, draws)).all()
+    assert (blocked_sampler.sample(rows, draws) == step_sampler.sample(rows, draws)).all()
+    shared = [block is blocked_block for block, blocked_block in zip(replaced_sampler.blocks, blocked_sampler.blocks)]
+    assert shared == [False, True, True, False, True, True]
+
+
+def test_snapshot_query():
+    curator = make_curator('dense')
+    network = curator.network
+    snapshots = NetworkSnapshots(curator)
+    snapshot = snapshots.current
+    probabilities = get_probabilities(curator)
+    with snapshots.editing():
+        network.set_link_utility(0, 0, 1, 5.0)
+    assert np.allclose(get_sampled_probabilities(snapshot.step_sampler, 2 * network.size, network.size),
+                       probabilities, atol=2 / DRAWS_PER_ROW)
+    sequence = snapshot.query(5, (0,) * network.size)
+    assert len(sequence) == 5 and set(sequence) <= set(node.name for node in network.nodes)
+    published = snapshots.publish()
+    assert published.version == 1 and published.names == snapshot.names
+    assert np.allclose(get_sampled_probabilities(published.step_sampler, 2 * network.size, network.size),
+                       get_probabilities(curator), atol=2 / DRAWS_PER_ROW)
+
+
+def test_decode_run():
+    for size, interactivity in ((5, 3), (70, 2), (30, 7)):
+        space = PreferenceSpace(size, interactivity)
+        last = space.cardinality - 1
+        for number, step, count in ((0, 1, 50), (last - 59, 1, 60), (12345, 977, 40), (last, -3, 30)):
+            expected = [space.decode(number + i * step) for i in range(count)]
+            assert space.decode_run(number, step, count).tolist() == [list(row) for row in expected]
+
+
+def test_get_batch():
+    for size, interactivity in ((5, 3), (70, 2)):
+        for space in (PreferenceSpace(size, interactivity), PreferenceSpace(size, interactivity)[::-7],
+                      PreferenceSpace(size, interactivity).strided(5, start=3)):
+            start, count = space.cardinality - 20, 50
+            expected = [space[(start + i) % space.cardinality] for i in range(count)]
+            assert space.get_batch(start, count).tolist() == [list(row) for row in expected]
+
+
+def test_rank_correlation():
+    assert average_ranks([3, 1, 3, 2, 3]).tolist() == [3, 0, 3, 1, 3]
+    assert np.isnan(rank_correlation(np.linspace(0.1, 1, 10), np.ones(10)))
+    assert np.isnan(rank_correlation(np.ones(10)[::-1], np.linspace(0.1, 1, 10)))
+    assert rank_correlation([1, 2, 3, 4], [10, 20, 30, 40]) == 1
+    assert rank_correlation([1, 2, 3, 4], [4, 3, 2, 1]) == -1
+    # Pearson correlation of the average ranks, by hand
+    distribution, approx_distribution = [0.1, 0.2, 0.2, 0.5], [0.3, 0.3, 0.1, 0.3]
+    ranks, approx_ranks = np.array([0, 1.5, 1.5, 3]), np.array([2, 2, 0, 2])
+    assert np.isclose(rank_correlation(distribution, approx_distribution), np.corrcoef(ranks, approx_ranks)[0, 1])
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'passed')
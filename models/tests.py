@@ -1,20 +1,27 @@
-from adversaries import Adversary
-from curators import Curator
-from databases import Network
+from caches import ResultCache
+from experiments import adversary_cell, network_cell, write_sweep
+from instruments import INSTRUMENTS, ProgressBar
 from matplotlib import pyplot
 import numpy as np
 
 
-PRINT = True
+PROCESSES = None
+SEED = 0
+# Queries sampled at once by Curator.query_many when pirating
+BLOCK_SIZE = 10000
+CACHE_DIRECTORY = 'cache'
 
 
-def kl_divergence(distribution, approx_distribution):
-    """Calculate the KL divergence for two distributions
+def mean_series(rows, key):
+    """Return cumulative query counts and the mean of a key over preferences
 
-    :param distribution: original probability distribution
-    :param approx_distribution: approximate of the original distribution
+    :param list rows: adversary_cell rows of one cell
+    :param str key: row key to average
+    :return: list of cumulative query counts and list of means
+    :rtype: tuple
     """
-    return tuple(np.sum(distribution) * np.log(np.array(distribution) / np.array(approx_distribution)))
+    queries = sorted(set(row['queries'] for row in rows))
+    return queries, [np.mean([row[key] for row in rows if row['queries'] == query]) for query in queries]
 
 
 def test_adversary():
@@ -28,35 +35,11 @@ def test_adversary():
     preference_count = 5
     query_counts = tuple(np.logspace(4, 4.5, num=10))
 
-    curator = Curator()
-    curator.network = Network(size, interactivity)
-    curator.network.make_random_links()
-    adversary = Adversary(curator)
-    preferences = tuple(curator.network.get_random_preferences() for _ in range(preference_count))
-
-    errors = {cutoff_fraction: {preference: [] for preference in preferences}
-              for cutoff_fraction in cutoff_fractions}
-    kl_divergences = {preference: [] for preference in preferences}
-    for query_count in query_counts:
-        adversary.pirate(sequence_length, number_of_queries=int(query_count))
-        for preference in preferences:
-            if PRINT:
-                print('Evaluating reconstruction with preference set %d' % (preferences.index(preference) + 1))
-            adversary_probabilities = adversary.network.sequence_probabilities(preference,
-                                                                               sequence_length,
-                                                                               Adversary.normalize)
-            curator_probabilities = curator.network.sequence_probabilities(preference,
-                                                                           sequence_length,
-                                                                           curator.exponential_mechanism)
-            for cutoff_fraction in cutoff_fractions:
-                cutoff_number = int(cutoff_fraction * len(curator_probabilities))
-                sorted_adversary_probabilities = sorted(adversary_probabilities)
-                error_count = (sum(adversary_probabilities[i] not in sorted_adversary_probabilities[:cutoff_number]
-                               for i in range(len(curator_probabilities[:cutoff_number]))))
-                errors[cutoff_fraction][preference].append(1.0 * error_count / cutoff_number)
-
-            # KL Divergence after a preference query
-            kl_divergences[preference].append(kl_divergence(curator_probabilities, adversary_probabilities))
+    cells = [{'size': size, 'interactivity': interactivity, 'sequence_length': sequence_length,
+              'eta': 1e-4, 'query_counts': query_counts, 'cutoff_fractions': cutoff_fractions,
+              'preference_count': preference_count, 'block_size': BLOCK_SIZE}]
+    rows = write_sweep(adversary_cell, cells, 'test_adversary.csv', seed=SEED, processes=PROCESSES,
+                       cache=ResultCache(CACHE_DIRECTORY))
 
     figure, (axes_error, axes_kl) = pyplot.subplots(1, 2)
     figure.canvas.set_window_title('Top Sequences Error and KL Divergence vs. Number of Queries')
@@ -69,14 +52,10 @@ def test_adversary():
     axes_kl.set_xscale('log')
     axes_kl.set_ylabel('KL Divergence')
     for cutoff_fraction in cutoff_fractions:
-        axes_error.plot([sum(query_counts[:i]) for i in range(1, len(query_counts) + 1)],
-                        [np.mean([errors[cutoff_fraction][preference][i] for preference in preferences])
-                         for i in range(len(query_counts))],
+        axes_error.plot(*mean_series(rows, 'error_%g' % cutoff_fraction),
                         label='Top %.2g%%' % (100 * cutoff_fraction))
     axes_error.legend(loc='best')
-    axes_kl.plot([sum(query_counts[:i]) for i in range(1, len(query_counts) + 1)],
-                 [np.mean([kl_divergences[preference][i] for preference in preferences])
-                  for i in range(len(query_counts))])
+    axes_kl.plot(*mean_series(rows, 'kl_divergence'))
     pyplot.show()
 
 
@@ -91,33 +70,11 @@ def test_adversary_no_kl():
     preference_count = 1
     query_counts = tuple(np.logspace(0, 6, num=30))
 
-    curator = Curator()
-    curator.network = Network(size, interactivity)
-    curator.network.make_random_links()
-    adversary = Adversary(curator)
-    preferences = tuple(curator.network.get_random_preferences() for _ in range(preference_count))
-
-    errors = {cutoff_fraction: {preference: [] for preference in preferences}
-              for cutoff_fraction in cutoff_fractions}
-    for query_count in query_counts:
-        if PRINT:
-            print()
-        adversary.pirate(sequence_length, number_of_queries=int(query_count))
-        for preference in preferences:
-            if PRINT:
-                print('Preference %d' % (preferences.index(preference) + 1))
-            adversary_probabilities = adversary.network.sequence_probabilities(preference,
-                                                                               sequence_length,
-                                                                               Adversary.normalize)
-            curator_probabilities = curator.network.sequence_probabilities(preference,
-                                                                           sequence_length,
-                                                                           curator.exponential_mechanism)
-            for cutoff_fraction in cutoff_fractions:
-                cutoff_number = int(cutoff_fraction * len(curator_probabilities))
-                sorted_adversary_probabilities = sorted(adversary_probabilities)
-                error_count = (sum(adversary_probabilities[i] not in sorted_adversary_probabilities[:cutoff_number]
-                               for i in range(len(curator_probabilities[:cutoff_number]))))
-                errors[cutoff_fraction][preference].append(1.0 * error_count / cutoff_number)
+    cells = [{'size': size, 'interactivity': interactivity, 'sequence_length': sequence_length,
+              'eta': 1e-4, 'query_counts': query_counts, 'cutoff_fractions': cutoff_fractions,
+              'preference_count': preference_count, 'block_size': BLOCK_SIZE}]
+    rows = write_sweep(adversary_cell, cells, 'test_adversary_no_kl.csv', seed=SEED, processes=PROCESSES,
+                       cache=ResultCache(CACHE_DIRECTORY))
 
     figure, axes_error = pyplot.subplots()
     figure.canvas.set_window_title('Top Sequences Error and KL Divergence vs. Number of Queries')
@@ -126,9 +83,7 @@ def test_adversary_no_kl():
     axes_error.set_xscale('log')
     axes_error.set_ylabel('Top Sequences Error')
     for cutoff_fraction in cutoff_fractions:
-        axes_error.plot([sum(query_counts[:i]) for i in range(1, len(query_counts) + 1)],
-                        [np.mean([errors[cutoff_fraction][preference][i] for preference in preferences])
-                         for i in range(len(query_counts))],
+        axes_error.plot(*mean_series(rows, 'error_%g' % cutoff_fraction),
                         label='Top %.2g%%' % (100 * cutoff_fraction))
     axes_error.legend(loc='best')
     pyplot.show()
@@ -146,40 +101,13 @@ def test_etas():
     preference_count = 1
     query_counts = tuple(np.logspace(0, 2.5, num=20))
 
-    curator = Curator()
-    curator.network = Network(size, interactivity)
-    curator.network.make_random_links()
-    adversaries = [Adversary(curator, eta=eta) for eta in etas]
-    preferences = tuple(curator.network.get_random_preferences() for _ in range(preference_count))
-
-    errors = {adversary: {cutoff_fraction: {preference: [] for preference in preferences}
-                          for cutoff_fraction in cutoff_fractions}
-              for adversary in adversaries}
-    kl_divergences = {adversary: {preference: [] for preference in preferences}
-                      for adversary in adversaries}
-    for query_count in query_counts:
-        for adversary in adversaries:
-            if PRINT:
-                print()
-            adversary.pirate(sequence_length, number_of_queries=int(query_count))
-            for preference in preferences:
-                if PRINT:
-                    print('Preference %d' % (preferences.index(preference) + 1))
-                adversary_probabilities = adversary.network.sequence_probabilities(preference,
-                                                                                   sequence_length,
-                                                                                   Adversary.normalize)
-                curator_probabilities = curator.network.sequence_probabilities(preference,
-                                                                               sequence_length,
-                                                                               curator.exponential_mechanism)
-                for cutoff_fraction in cutoff_fractions:
-                    cutoff_number = int(cutoff_fraction * len(curator_probabilities))
-                    sorted_adversary_probabilities = sorted(adversary_probabilities)
-                    error_count = (sum(adversary_probabilities[i] not in sorted_adversary_probabilities[:cutoff_number]
-                                   for i in range(len(curator_probabilities[:cutoff_number]))))
-                    errors[adversary][cutoff_fraction][preference].append(1.0 * error_count / cutoff_number)
-
-                # KL Divergence after a preference query
-                kl_divergences[adversary][preference].append(kl_divergence(curator_probabilities, adversary_probabilities))
+    # Every eta pirates the same curator network
+    cells = [{'size': size, 'interactivity': interactivity, 'sequence_length': sequence_length,
+              'eta': eta, 'query_counts': query_counts, 'cutoff_fractions': cutoff_fractions,
+              'preference_count': preference_count, 'network_seed': SEED, 'block_size': BLOCK_SIZE}
+             for eta in etas]
+    rows = write_sweep(adversary_cell, cells, 'test_etas.csv', seed=SEED, processes=PROCESSES,
+                       cache=ResultCache(CACHE_DIRECTORY))
 
     figure, (axes_error, axes_kl) = pyplot.subplots(1, 2)
     figure.canvas.set_window_title('Top Sequences Error and KL Divergence vs. Number of Queries')
@@ -191,18 +119,15 @@ def test_etas():
     axes_kl.set_xlabel('Number of Queries')
     axes_kl.set_xscale('log')
     axes_kl.set_ylabel('KL Divergence')
-    for adversary in adversaries:
+    for cell_number, eta in enumerate(etas):
+        cell_rows = [row for row in rows if row['cell'] == cell_number]
         for cutoff_fraction in cutoff_fractions:
-            axes_error.plot([sum(query_counts[:i]) for i in range(1, len(query_counts) + 1)],
-                            [np.mean([errors[adversary][cutoff_fraction][preference][i] for preference in preferences])
-                             for i in range(len(query_counts))],
-                            lw=3, label='Top %.2g%% (Eta = %.3g)' % (100 * cutoff_fraction, adversary.eta))
+            axes_error.plot(*mean_series(cell_rows, 'error_%g' % cutoff_fraction),
+                            lw=3, label='Top %.2g%% (Eta = %.3g)' % (100 * cutoff_fraction, eta))
     axes_error.legend(loc='best')
-    for adversary in adversaries:
-        axes_kl.plot([sum(query_counts[:i]) for i in range(1, len(query_counts) + 1)],
-                     [np.mean([kl_divergences[adversary][preference][i] for preference in preferences])
-                      for i in range(len(query_counts))],
-                     lw=3, label='Eta = %.3g' % adversary.eta)
+    for cell_number, eta in enumerate(etas):
+        cell_rows = [row for row in rows if row['cell'] == cell_number]
+        axes_kl.plot(*mean_series(cell_rows, 'kl_divergence'), lw=3, label='Eta = %.3g' % eta)
     pyplot.show()
 
 
@@ -216,9 +141,8 @@ def test_network():
     variables = fractions_of_links_defined
     variable_name = 'Fraction of Links Defined'
     number_of_repeat_runs = 2
-    if PRINT:
-        print('Testing model by varying ' + variable_name +
-              ' as ' + ', '.join([str(x) for x in fractions_of_links_defined]))
+    INSTRUMENTS.progress('Testing model by varying ' + variable_name +
+                         ' as ' + ', '.join([str(x) for x in fractions_of_links_defined]), 0, 0)
 
     figure, (link_axes, sequence_axes) = pyplot.subplots(2, 1)
     figure.canvas.set_window_title('Content Network with Varying ' + variable_name)
@@ -240,6 +164,7 @@ def test_network():
     # sequence_colors = [next(sequence_axes._get_lines.color_cycle) for _ in range(len(variables))]
     sequence_colors = ['r', 'y', 'g', 'c', 'b']
 
+    cells = []
     for run_number in range(len(variables)):
         variable = variables[run_number]
         epsilon = variable if epsilons == variables else epsilons[0]
@@ -248,37 +173,36 @@ def test_network():
         number_of_responses = variable if numbers_of_responses == variables else numbers_of_responses[0]
         sequence_length = variable if sequence_lengths == variables else sequence_lengths[0]
         utility_skew_power = variable if utility_skew_powers == variables else utility_skew_powers[0]
-
         for repeat_run_number in range(number_of_repeat_runs):
-            curator = Curator()
-            curator.network = Network(size=number_of_nodes, interactivity=number_of_responses)
-            curator.network.make_random_links(density=fraction_of_links_defined, skew_power=utility_skew_power)
-            preferences = curator.network.get_random_preferences()
-            if PRINT:
-                print('%d Nodes, %d Responses, Sequences of %d, Density=%.3g, Epsilon=%.3g, Skew=%.3g, Run %d' %
-                      (number_of_nodes, number_of_responses, sequence_length,
-                       fraction_of_links_defined, epsilon, utility_skew_power, repeat_run_number))
-            sequence_probabilities = sorted([probability for probability in
-                                             curator.network.sequence_probabilities(preferences,
-                                                                                    sequence_length,
-                                                                                    curator.exponential_mechanism)
-                                             if probability > 10 ** (- sequence_length)], reverse=True)
-            link_utilities = sorted([link.utility
-                                     for node in curator.network.nodes
-                                     for links in node.links.values()
-                                     for link in links.values()], reverse=True)
-            assert all(probability for probability in sequence_probabilities)
-
-            label = str(variable) + ' ' + variable_name
-            link_color = link_colors[run_number]
-            sequence_color = sequence_colors[run_number]
-            link_graph, = link_axes.plot(range(len(link_utilities)), link_utilities, c=link_color, lw=3)
-            sequence_graph, = sequence_axes.plot(range(len(sequence_probabilities)),
-                                                 sequence_probabilities,
-                                                 alpha=0.7, c=sequence_color, lw=3)
-            if not repeat_run_number:
-                link_graph.set_label(label)
-                sequence_graph.set_label(label)
+            cells.append({'repeat': repeat_run_number, 'epsilon': epsilon,
+                          'density': fraction_of_links_defined, 'size': number_of_nodes,
+                          'interactivity': number_of_responses, 'sequence_length': sequence_length,
+                          'skew_power': utility_skew_power})
+    rows = write_sweep(network_cell, cells, 'test_network.csv', seed=SEED, processes=PROCESSES,
+                       cache=ResultCache(CACHE_DIRECTORY))
+
+    for cell_number, cell in enumerate(cells):
+        run_number = cell_number // number_of_repeat_runs
+        INSTRUMENTS.progress('%d Nodes, %d Responses, Sequences of %d, Density=%.3g, Epsilon=%.3g, Skew=%.3g, Run %d' %
+                             (cell['size'], cell['interactivity'], cell['sequence_length'],
+                              cell['density'], cell['epsilon'], cell['skew_power'], cell['repeat']),
+                             0, 0)
+        sequence_probabilities = [row['value'] for row in rows
+                                  if row['cell'] == cell_number and row['kind'] == 'sequence']
+        link_utilities = [row['value'] for row in rows
+                          if row['cell'] == cell_number and row['kind'] == 'link']
+        assert all(probability for probability in sequence_probabilities)
+
+        label = str(variables[run_number]) + ' ' + variable_name
+        link_color = link_colors[run_number]
+        sequence_color = sequence_colors[run_number]
+        link_graph, = link_axes.plot(range(len(link_utilities)), link_utilities, c=link_color, lw=3)
+        sequence_graph, = sequence_axes.plot(range(len(sequence_probabilities)),
+                                             sequence_probabilities,
+                                             alpha=0.7, c=sequence_color, lw=3)
+        if not cell['repeat']:
+            link_graph.set_label(label)
+            sequence_graph.set_label(label)
 
     link_axes.legend()
     sequence_axes.legend()
@@ -286,4 +210,6 @@ def test_network():
 
 
 if __name__ == '__main__':
+    INSTRUMENTS.progress_callbacks.append(ProgressBar())
+    INSTRUMENTS.enable()
     test_network()